@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+import numpy as np
+import os, sys, types, time, json, argparse, tempfile, zipfile, struct, platform
+import contextlib, io
+
+SIZES = {  # parts, facets per part, ports
+    'small':  (10, 200, 2),
+    'medium': (50, 2000, 4),
+    'large':  (200, 20000, 8),
+}
+DEFAULT_SIZES = [ 'small', 'medium' ]
+DEFAULT_REPEAT = 3
+DEFAULT_SAMPLES = 20000  # port signal length
+DEFAULT_POINTS = 1000
+PITCH = 0.5e-3
+FREQUENCY = 2e9
+SLOWER = 10  # percent, flagged by --compare
+
+
+#####################
+# stand-ins for the openEMS and CSXCAD objects used by rfems
+
+class Grid:
+    def __init__(self):
+        self.lines = [ [], [], [] ]
+
+    def SetDeltaUnit(self, unit):
+        self.unit = unit
+
+    def AddLine(self, d, lines):
+        self.lines['xyz'.index(d)] += list(np.atleast_1d(lines))
+
+    def SetLines(self, d, lines):
+        self.lines['xyz'.index(d)] = list(np.atleast_1d(lines))
+
+    def GetLines(self, d):
+        return np.unique(self.lines['xyz'.index(d)])
+
+    def SmoothMeshLines(self, d, resolution, ratio=1.5):
+        for n in range(3) if d == 'all' else [ 'xyz'.index(d) ]:
+            lines = np.unique(self.lines[n])
+            result = [ lines[:1] ]
+            for a, b in zip(lines[:-1], lines[1:]):
+                count = int(np.ceil((b - a) / resolution - 1e-9))
+                result.append(np.linspace(a, b, count + 1)[1:])
+            self.lines[n] = list(np.concatenate(result))
+
+
+class Primitive:
+    def __init__(self, *args, **kw):
+        self.args = args
+
+    def ReadFile(self):
+        # openems parses the file, read it at least
+        with open(self.args[0], 'rb') as f:
+            f.read()
+        return True
+
+
+class Property:
+    def __init__(self, name, **kw):
+        self.name = name
+        self.primitives = []
+
+    def SetColor(self, color):
+        pass
+
+    def add(self, *args, **kw):
+        primitive = Primitive(*args, **kw)
+        self.primitives.append(primitive)
+        return primitive
+
+    AddBox = AddCylinder = AddLinPoly = AddPolyhedronReader = add
+
+
+class ContinuousStructure:
+    def __init__(self):
+        self.grid = Grid()
+        self.properties = []
+
+    def GetGrid(self):
+        return self.grid
+
+    def AddMaterial(self, name, **kw):
+        self.properties.append(Property(name, **kw))
+        return self.properties[-1]
+
+    AddMetal = AddConductingSheet = AddMaterial
+
+
+class NF2FF:
+    def __init__(self, CSX, name, start, stop, **kw):
+        self.name, self.start, self.stop = name, start, stop
+
+
+class OpenEMS:
+    def __init__(self, **kw):
+        self.ports = []
+
+    def SetGaussExcite(self, fo, fc):
+        pass
+
+    def SetBoundaryCond(self, boundary):
+        pass
+
+    def SetCSX(self, CSX):
+        self.CSX = CSX
+
+    def AddLumpedPort(self, **kw):
+        self.ports.append(kw)
+        return kw
+
+    def CreateNF2FFBox(self, name='nf2ff', start=None, stop=None, **kw):
+        return NF2FF(self.CSX, name, start, stop, **kw)
+
+
+def install_stand_ins():
+    modules = {
+        'openEMS': { 'openEMS': OpenEMS },
+        'openEMS.physical_constants': { 'C0': 299792458.0 },
+        'openEMS.nf2ff': { 'nf2ff': NF2FF },
+        'CSXCAD': { 'ContinuousStructure': ContinuousStructure },
+    }
+    for name, attrs in modules.items():
+        module = types.ModuleType(name)
+        module.__dict__.update(attrs)
+        sys.modules[name] = module
+    sys.modules['openEMS'].physical_constants = sys.modules['openEMS.physical_constants']
+    sys.modules['openEMS'].nf2ff = sys.modules['openEMS.nf2ff']
+
+
+#####################
+# synthetic models
+
+def binary_stl(facets):
+    normal = np.zeros((len(facets), 3), dtype=np.float32)
+    data = np.concatenate([ normal, facets.reshape(-1, 9).astype(np.float32) ], axis=1)
+    record = np.zeros(len(facets), dtype=[ ('data', '<f4', 12), ('attr', '<u2') ])
+    record['data'] = data
+    return b'\0' * 80 + struct.pack('<I', len(facets)) + record.tobytes()
+
+
+def box_facets(start, stop):
+    v = np.array([ [ (stop if k & m else start)[n] for n, m in enumerate((1, 2, 4)) ] for k in range(8) ])
+    faces = [ (0, 1, 3), (0, 3, 2), (4, 6, 7), (4, 7, 5), (0, 4, 5), (0, 5, 1),
+              (2, 3, 7), (2, 7, 6), (0, 2, 6), (0, 6, 4), (1, 5, 7), (1, 7, 3) ]
+    return v[np.array(faces)]
+
+
+def sphere_facets(center, radius, facets):
+    # uv sphere with about the requested number of facets
+    n = max(3, int(np.sqrt(facets / 2)))
+    theta = np.linspace(0, np.pi, n + 1)
+    phi = np.linspace(0, 2 * np.pi, 2 * n + 1)
+    T, P = np.meshgrid(theta, phi, indexing='ij')
+    p = np.stack([ np.sin(T) * np.cos(P), np.sin(T) * np.sin(P), np.cos(T) ], axis=-1) * radius + center
+    a, b, c, d = p[:-1,:-1], p[1:,:-1], p[1:,1:], p[:-1,1:]
+    return np.concatenate([ np.stack([ a, b, c ], axis=2).reshape(-1, 3, 3),
+                            np.stack([ a, c, d ], axis=2).reshape(-1, 3, 3) ])
+
+
+def make_zip(filename, parts, facets, ports):
+    # a row of copper spheres and boxes on a substrate, ports along the edge
+    size = 4 * parts
+    with zipfile.ZipFile(filename, 'w') as z:
+        z.writestr('box-air.stl', binary_stl(box_facets([ -10, -10, -10 ], [ size + 10, 20, 20 ])))
+        z.writestr('substrate-epsilon=3.38.stl', binary_stl(box_facets([ 0, 0, 0 ], [ size, 10, 1.5 ])))
+        for k in range(parts):
+            name = f'part{k + 1}-copper priority=10.stl'
+            if k % 2:
+                data = box_facets([ 4 * k + 1, 2, 1.5 ], [ 4 * k + 3, 8, 1.535 ])
+            else:
+                data = sphere_facets(np.array([ 4 * k + 2, 5, 4 ]), 1.5, facets)
+            z.writestr(name, binary_stl(data))
+        for k in range(ports):
+            x = size * (k + 0.5) / ports
+            z.writestr(f'port z {k + 1}.stl', binary_stl(box_facets([ x - .5, 0, 0 ], [ x + .5, 1, 1.5 ])))
+
+
+def write_ports(sim_path, nport, samples):
+    # openems style probe files
+    dt = 1e-12
+    t = np.arange(samples) * dt
+    for k in range(1, nport + 1):
+        u = np.exp(-((t - 4e-10) * 4e9) ** 2) * np.cos(2 * np.pi * FREQUENCY * t) * (1 if k == 1 else .1)
+        for name, x in [ (f'port_ut{k}', u), (f'port_it{k}', u / 50) ]:
+            np.savetxt(os.path.join(sim_path, name), np.c_[t, x], header='t/s value', comments='% ')
+
+
+#####################
+
+def timed(phases, name, func, *args):
+    with contextlib.redirect_stdout(io.StringIO()):
+        elapsed = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - elapsed
+    phases[name] = min(phases.get(name, np.inf), elapsed)
+    return result
+
+
+def run_size(rfems, dirname, size, repeat, samples):
+    parts, facets, ports = SIZES[size]
+    filename = os.path.join(dirname, f'{size}.zip')
+    make_zip(filename, parts, facets, ports)
+    rfems.args = rfems.options(filename, pitch=PITCH, frequency=FREQUENCY, points=DEFAULT_POINTS,
+        no_cache=True, stop=0)
+    sim_path = os.path.join(dirname, f'{size}-sim')
+    os.makedirs(sim_path, exist_ok=True)
+    write_ports(sim_path, ports, samples)
+    frequency = rfems.get_frequencies()
+    output = os.path.join(dirname, f'{size}-out.npz')
+
+    phases = {}
+    for k in range(repeat):
+        members = timed(phases, 'unzip_models', rfems.unzip_models, filename)
+        digests = rfems.hash_models(members)
+        models = timed(phases, 'parse_stl', rfems.load_models, members, digests)
+        rfems.write_polyhedra(models, members, digests, os.path.join(dirname, f'{size}-mod'))
+        lines = timed(phases, 'mesh', rfems.build_mesh, models, [])
+
+        def build():
+            CSX = ContinuousStructure()
+            FDTD = rfems.setup_simulation(CSX, [])
+            rfems.add_parts(CSX, models)
+            rfems.add_ports(FDTD, models, 0)
+            rfems.set_mesh(CSX, lines)
+        timed(phases, 'add_parts', build)
+
+        z = rfems.port_impedances(models)
+        def post():
+            return rfems.calc_column(rfems.read_ports(sim_path, ports), z, 0, frequency)
+        column = timed(phases, 'calc_port', post)
+        s = np.zeros((len(frequency), ports, ports), dtype=np.complex128)
+        s[:,:,0] = column
+        timed(phases, 'save_results', rfems.save_results, output, frequency, s, z, {})
+
+    cells = rfems.mesh_cells(lines)
+    return { 'size': size, 'parts': parts, 'facets': facets, 'ports': ports,
+             'samples': samples, 'cells': cells, 'phases': phases }
+
+
+def compare(results, filename):
+    with open(filename) as f:
+        baseline = { r['size']: r['phases'] for r in json.load(f)['results'] }
+    for result in results:
+        if result['size'] not in baseline:
+            continue
+        for name, elapsed in result['phases'].items():
+            old = baseline[result['size']].get(name)
+            if old:
+                change = (elapsed - old) / old * 100
+                flag = '  SLOWER' if change > SLOWER else ''
+                print(f'{result["size"]:8s} {name:14s} {old:9.4f} s -> {elapsed:9.4f} s {change:+7.1f}%{flag}')
+
+
+def parse_args():
+    formatter_class = argparse.ArgumentDefaultsHelpFormatter
+    parser = argparse.ArgumentParser(formatter_class=formatter_class,
+        description='time the rfems phases on synthetic models, without openEMS')
+    parser.add_argument('--sizes', nargs='+', choices=list(SIZES), default=DEFAULT_SIZES,
+        help='model sizes to run')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+        help='runs per size, the fastest is kept')
+    parser.add_argument('--samples', type=int, default=DEFAULT_SAMPLES,
+        help='samples per port signal')
+    parser.add_argument('--output',
+        help='json output file')
+    parser.add_argument('--compare',
+        help='json output file of an earlier run to compare with')
+    return parser.parse_args()
+
+
+def main():
+    install_stand_ins()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import rfems
+
+    results = []
+    with tempfile.TemporaryDirectory() as dirname:
+        for size in args.sizes:
+            result = run_size(rfems, dirname, size, args.repeat, args.samples)
+            results.append(result)
+            phases = ', '.join(f'{k} {v:.4f} s' for k, v in result['phases'].items())
+            print(f'{size}: {result["parts"]} parts, {result["cells"]} cells, {phases}')
+
+    report = { 'python': platform.python_version(), 'numpy': np.__version__,
+               'machine': platform.machine(), 'results': results }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main()
@@ -18,6 +18,14 @@ from pylab import *
 class loadz(object):
     def __init__(self, filename):
         root, ext = os.path.splitext(filename)
+        dirname = filename if os.path.isdir(filename) else f'{root}.results'
+        if os.path.isdir(dirname) and not os.path.exists(f'{root}.npz'):
+            # --store npy, memory map the arrays and read only what is plotted
+            for name in os.listdir(dirname):
+                key, ext = os.path.splitext(name)
+                if ext == '.npy':
+                    setattr(self, key, np.load(os.path.join(dirname, name), mmap_mode='r'))
+            return
         if ext != f'.npz':
             filename = f'{root}.npz'
         with np.load(filename) as my_dict:
@@ -63,12 +63,175 @@ lying on top of a substrate material should have a higher priority set, see patc
 All these models must be then zipped up into a single zip file.  This zip file is
 presented to rfems as the complete model to simulate.  To view the complete model use the --show option.
 
+Rfems reads the STL models straight out of the zip file without extracting it.
+Only the models that openEMS has to read back as polyhedra are written to disk, into a temporary
+directory or into the directory given by the --workdir option.  Files in the work directory are
+named by the hash of their contents, so a persistent --workdir is only written to when a model changes.
+
+Reading a STL model as a polyhedron is slow in openEMS for large models, so rfems first tries to
+recognize every model as a native CSXCAD primitive.  Axis-aligned boxes become boxes, axis-aligned
+prisms whose vertices lie on a circle become cylinders, and other constant cross-section extrusions
+along an axis become linear polygons.  A model is only replaced when the primitive matches it within
+--primitive-tol times the pitch, otherwise it stays a polyhedron.  Rfems prints how many models
+were recognized as each primitive.  Use '--primitive-tol 0' to read every solid as a polyhedron.
+
+## Mesh Conditioning
+
+By default the whole model is meshed with the uniform --pitch cell size, so resolving a small
+coupling gap forces the same small cells through all the air around it.  With '--mesh graded'
+the --pitch cell size is only used at the edges of conductors and ports, and in the gaps between them.
+Away from these edges the cells grow by at most the --grading ratio per cell up to a largest cell
+of the shortest wavelength in the sweep divided by --cells-per-wavelength, reduced by the square root
+of epsilon inside dielectrics.  Rfems prints the graded cell count next to the cell count of the uniform mesh.
+
+Rfems places mesh lines at the bounding box edges of every model and then smooths the mesh
+to the --pitch cell size.  Edges that differ by a few microns would create tiny cells, which
+force openEMS to use a tiny timestep and can make a simulation many times slower.  So before
+smoothing, mesh lines closer than --snap times the pitch are merged into one line, keeping the
+line of the model with the highest priority.  After smoothing rfems prints the smallest cell
+and the resulting timestep, and warns when the smallest cell is more than --cell-ratio times less
+than the pitch.  With --strict-mesh rfems stops with an error instead.
+
+## Symmetry and Conducting Sheets
+
+Models that are mirror symmetric can be simulated in half or a quarter of the domain with
+the --symmetry option.  With '--symmetry auto' rfems checks the planes through the center of the model
+along every axis, and uses a plane when every material maps onto itself in the mirror and
+every port straddles the plane.  The planes can also be given as their normals, like '--symmetry xy'.
+Only the upper half of the mesh is kept, and the plane becomes a PMC wall for ports parallel to it,
+with twice the port impedance, or a PEC wall for ports normal to it, with half the port impedance.
+The s-parameters are calculated with these impedances, which gives the s-parameters of the full model,
+and the far field is calculated with the mirror image of the near field.  The patch example
+has a symmetry plane at y = 0, which halves its cell count.
+
+Thin metal parts, like copper foil on a circuit board, need cells as small as their thickness
+when they are meshed as a volume of kappa material, and those cells shrink the timestep.  With --sheets,
+boxes thinner than the pitch that are made of one of the metals in the material table, or of a custom
+kappa material without epsilon, are modeled as openEMS conducting sheets instead.  A sheet has no thickness in
+the mesh, but keeps the conductivity and the real thickness for the conductor loss.  The sheet is placed on
+the face of the part that touches another part, like a substrate, or on its mid-plane otherwise.
+Parts that are thinner than 1 um in the STL file, which rfems otherwise flattens to zero thickness, also
+become sheets with their STL thickness.  Boxes are only recognized with a --primitive-tol above 0.
+Rfems prints the number of cells and the timestep with and without the sheets, or a warning when no
+part qualifies.
+
+## Validation, Cost and Profiling
+
+Use --validate to check a model before meshing it.  Rfems reads only the names in the zip file and
+reports every port without a number or direction, ports that are not numbered 1 to N, bad epsilon,
+kappa, zo or priority values, and unknown materials, which are simulated as pec.  OpenEMS is
+only imported once a simulation is built, so --validate and --help work without it installed.
+
+Use --dry-run to find out what a simulation will cost before running it.  Rfems builds the mesh
+and prints the cells along every axis, the total cell count, the timestep of the smallest cell,
+an estimate of the number of timesteps from the length of the gaussian excitation and the --criteria
+end criteria, the field memory and a runtime projection.  The projection uses the throughput in
+cells times timesteps per second measured by the last single job simulation on the machine, which is stored
+in the cache directory.  OpenEMS is not started, so a dry run takes seconds.  The number of
+timesteps assumes a low Q model, high Q filters ring longer.
+
+To find out where the time of a long simulation goes, add '--profile trace.json'.  Rfems records the
+wall time and the peak memory of reading the zip file, loading the models, meshing, writing the STL files
+and saving the results, and of building the model, running openEMS, calculating the s-parameters and the far
+field for every excitation.  On linux the peak memory is that of each phase, elsewhere only the
+peak of the process so far is known and is recorded as such.  The openEMS output is also written to openems.log in the simulation directory,
+and the number of timesteps, the cells and the speed that openEMS reports are added to the trace.  The
+trace uses the chrome trace format, so it can be opened in chrome://tracing or ui.perfetto.dev.  The
+speed reported by openEMS also replaces the estimated throughput used by --dry-run.  To profile the python
+code of a phase, list it with --cprofile, like '--cprofile calc_port', which writes a .prof file
+next to the trace for every run of the phase.
+
 ## S-parameter Support
 
 After each simulation the s-parameter result is written out to a .npz numpy formatted
 data file.  The s parameters are in the 's' variable, the frequency points are in
 the 'f' variable.  The 'z' variable is an array of each port's characteristic impedance.
 
+Every port excitation is a separate FDTD run that fills one column of the s-parameter
+matrix.  Use the --jobs option to run several excitations at the same time, each in
+its own process and simulation directory.  The --threads count is divided evenly
+between the jobs, so a 4 port model on a 32 core machine can use '--jobs 4 --threads 32'
+to run four 8 thread simulations at once.
+
+Symmetric filters and couplers often have ports that are mirror images of each other, so exciting
+port 2 gives the same fields as exciting port 1, mirrored.  With --port-symmetry rfems checks the mirrors
+about the center planes of the model and the 180 degree rotations about its center axes.  When a
+transform maps the whole model onto itself and the ports onto other ports with the same impedance, only one
+port of every such set is excited.  The other columns of the s-parameter matrix are copied from it with the
+rows reordered, and with the sign changed for transmission between ports whose polarity the transform reverses.
+
+After every excitation rfems reads the voltage and current files of all the ports once and transforms
+the signals that share a time base together.  For evenly spaced frequency points, which is every
+--points setting above 2, the spectra are calculated with a chirp-z transform instead of a direct DFT.
+This is many times faster for long simulations and dense sweeps, and the results agree with the
+incident and reflected waves of the openEMS CalcPort method to within 1e-9 of the largest value.
+
+Finished results are also kept in a local cache, by default $XDG_CACHE_HOME/rfems or ~/.cache/rfems,
+see the --cache-dir option.  Results are keyed by a hash of the STL files and of every option
+that changes the simulation, like the pitch, frequency sweep, end criteria, farfield grid and port range.
+Running rfems again on the same zip file with the same options copies the cached result
+to the output file without simulating.  The least recently used results are removed once the
+cache grows beyond --cache-size megabytes.  Use --no-cache to always simulate.
+
+Results are written as the simulation runs, so a crash in the last excitation does not lose the
+columns that are already finished.  Every s-parameter column and the far field arrays are saved to a
+.partial directory next to the output file as soon as they are calculated, and are collected into
+the .npz file at the end.  With '--store npy' the directory is kept instead, as examples/inter.results,
+holding one .npy file per key.  examples/showresult.py and the load_results function of rfems
+memory map these files, so only the parts that are used are read from disk, and both accept the
+.npz name of the output.  A finished run removes the output of the other store format, so an older
+.npz or .results is never read in place of the new result.  Add --complex64 to store the s-parameters and far fields in single precision.
+
+The store also records which port excitations have finished, together with a hash of the STL files
+and the options.  When rfems is started again after a crash or on a preempted node, it skips the
+finished excitations and only simulates the remaining ones.  The same happens with --start and --stop,
+so running '--start 1 --stop 2' and then '--start 3 --stop 4' on a 4 port model
+leaves the complete s-parameter matrix in the output file, without merging files by hand.  The .partial
+directory is removed once every port has been excited.  Running the same ports again after a run
+that was not interrupted simulates them again, only the ports of the other runs are kept.  Use
+--restart to discard the finished excitations and simulate from the beginning.
+
+High Q models like cavity filters ring for a long time after the excitation, so reaching a
+--criteria energy decay of -60 dB can take hours.  With the --converge option rfems instead reads the
+port voltages and currents every --converge-interval seconds while openEMS runs and recalculates the
+s-parameters.  Once two consecutive estimates differ by less than the given tolerance, rfems stops
+openEMS and prints about how many timesteps were saved compared to the end criteria, estimated from the
+decay of the port signals.  Add --extrapolate to continue the remaining ringdown of every port signal
+with a matrix pencil fit of its tail before calculating the s-parameters.
+
+The --keep-signals option saves the voltage and current of every port, for every excitation,
+next to the output file, so that examples/inter.npz gets an examples/inter.signals.npz archive.
+The s-parameters can then be recalculated for a different frequency sweep or different port
+impedances without simulating again, for example
+'python rfems.py reprocess examples/inter.npz inter-75.npz --line 75 --points 2000'.
+Options that are not given are taken from the simulation.  The far field cannot be recalculated
+this way, since it needs the near field dumps of the simulation.  Results are not cached when
+--keep-signals is set, so that the signals are always written.  A resumed run adds its
+excitations to the archive of the earlier runs, and warns about excitations that were finished
+without --keep-signals.
+
+Parsed STL models are cached separately, in the geometry directory of the cache, keyed by a hash
+of each STL file.  Every entry holds the facets, the bounding box and whether the model is
+a flat box, a solid box, a cylinder, an extrusion or a general polyhedron, with the axis, radius or
+outline of a recognized primitive.  When only one part of a large assembly changes,
+only that STL file is parsed again.  Rfems prints the geometry cache hits and misses, and keeps the
+geometry cache under --geometry-cache-size megabytes.
+
+Rfems can also be used from python, which saves starting python and loading openEMS for every
+run of a sweep.  The Simulation class takes the input file and the long command line options as
+keywords, with underscores instead of dashes.  Every call of its run method simulates with these options,
+or with the options given to run for that call, and returns the f, s, z and far field arrays.
+A bad option or model raises rfems.RfemsError, a ValueError, so one failing variant does not end
+the sweep.  --show-model and --dump-pec are only available from the command line.  The
+options are swapped into the rfems module for the length of a run, so runs in one process must
+not overlap, in threads or otherwise; run separate processes to simulate in parallel.
+
+```
+import rfems
+sim = rfems.Simulation('examples/inter.zip', frequency=1.296e9, span=4.4e8, stop=0)
+results = [ sim.run(pitch=pitch) for pitch in [ 2e-3, 1e-3, 0.5e-3 ] ]
+```
+
 ## Antenna Far Field Support
 
 Rfems supports the generation of far field radiation patterns using the option
@@ -80,11 +243,35 @@ The radiation pattern is included in the .npz file output.
 See the showresults.py file in the examples directory for the list of variables written
 out (these are also the same variables generated by openEMS).
 
+Use --farfield-frequencies to choose the far field frequencies instead, either as a list
+like '--farfield-frequencies 1.9e9 2e9 2.1e9' or as a single count like '--farfield-frequencies 11'
+for evenly spaced frequencies across the sweep.  All frequencies are calculated by one nf2ff call,
+which reads the near field data once, and the patterns are stacked along the frequency axis of the
+freq, Dmax, Prad and E_ arrays in the output file.  --farfield-jobs splits the frequencies between
+processes, each of which reads the near field data into memory again and runs its own multithreaded
+nf2ff, so only use a few when memory allows.
+
+Fine --dtheta and --dphi steps make the far field calculation slow and the output file large,
+although most of a pattern is smooth.  With '--adaptive 1' rfems starts from a 15 degree grid and
+halves the theta and phi steps only where neighbouring points differ by more than 1 dB, like at the
+edges of the main lobe, nulls and sidelobes, down to the --dtheta and --dphi steps.  The
+refinement stops before the grid would grow past --adaptive-points angles.  The phi = 0 and 90
+degree cuts used by examples/showresult.py are always part of the grid, and Dmax is integrated over
+the nonuniform grid.  For every far field frequency rfems prints Dmax and the half power beamwidth in the
+xz and yz planes, which is also saved as beamwidth in the output file.
+
 When enabling farfield, the boundary surrounding your model will switch from PEC
 to MUR.  To put space between your antenna model and this MUR boundary create a STL model
 and name it using the material name air.   See the examples, cup.py and patch.py for
 examples of how this works.
 
+Instead of drawing an air model, use --airbox to let rfems size the simulation box.  The models,
+without any air models, are padded on every side by the given fraction of the longest wavelength
+in the sweep, so '--airbox 0.25' leaves a quarter wavelength of free space at the lowest frequency.
+The far field box is placed halfway between the models and the edge of the padding.  With --pml the
+MUR boundaries are replaced by 8 cell PML absorbers, which reflect less and so allow a smaller
+--airbox fraction.  The cells taken by the PML are added to the padding.
+
 ## Dependencies
 
 To run rfems:
@@ -125,6 +312,15 @@ $ python examples/showresult.py examples/inter.npz
 ![](res/filter-model.png)
 ![](res/filter-sparam.png)
 
+## Benchmark
+
+To check whether a change slows rfems down, run 'python benchmark.py --output before.json' before
+the change and 'python benchmark.py --compare before.json' after it.  The benchmark builds synthetic
+zip files of growing size, in parts, facets per part and ports, and times reading the zip file, parsing
+the STL files, meshing, adding the parts and ports, calculating the s-parameters from port signals and
+saving the results.  It replaces openEMS and CSXCAD by small stand-ins, so it runs on any machine
+with numpy, and it does not time the FDTD simulation itself.
+
 ## Usage
 
 ```
@@ -134,6 +330,9 @@ $ { run("python rfems.py --help") }
 ## Notes
 
 Openscad cannot create STL models of planar surfaces.  As a work around, use a very small value for the flat dimension instead of zero.  Rfems flattens all STL files with bounding box dimensions less than or equal to 1e-6 m (or 1e-3 in STL units) to their planar 2D and 1D box equivalent.  See patch.py.  STL files are considered to use millimeter units.
-""")
-
 
+Both ASCII and binary STL files are supported.  Binary STL files store their vertices
+as 32-bit floats, so rfems rejects a binary file when the float spacing at its largest
+coordinate is coarser than the 1e-3 STL unit flattening tolerance above.  Export ASCII STL
+for very large models placed far from the origin.
+""")
@@ -1,12 +1,28 @@
 
 import numpy as np
 import zipfile, tempfile, os, sys, argparse, platform, struct
-from openEMS.physical_constants import C0
-from openEMS import openEMS
-from CSXCAD import ContinuousStructure
+import hashlib, json, shutil, time
+import contextlib, cProfile, re, threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import Process
+from numpy.lib.format import open_memmap
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# openEMS and CSXCAD load their native libraries on import, they are
+# imported where a simulation is built so --help and --validate stay fast
+C0 = 299792458  # m/s
 
 STL_TOL = .001  # mm
 STL_UNIT = 1e-3
+STL_HEADER = 80
+STL_DTYPE = np.dtype([
+    ('normal', '<f4', (3,)),
+    ('vertex', '<f4', (3, 3)),
+    ('attribute', '<u2'),
+])
 
 DEFAULT_PITCH = 1e-3
 DEFAULT_POINTS = 1000  # even to ensure group delay calculation
@@ -14,6 +30,50 @@ DEFAULT_REFERENCE = 50
 DEFAULT_PRIORITY = 0
 DEFAULT_DPHI = 2
 DEFAULT_DTHETA = 2
+DEFAULT_CACHE_SIZE = 1000  # MB
+DEFAULT_GEOMETRY_CACHE_SIZE = 200  # MB
+DEFAULT_PRIMITIVE_TOL = 0.1  # pitch
+DEFAULT_SNAP = 0.05  # pitch
+DEFAULT_CELL_RATIO = 10
+DEFAULT_CELLS_PER_WAVELENGTH = 20
+DEFAULT_GRADING = 1.5
+DEFAULT_CRITERIA = -50  # dB, openems default end criteria
+DEFAULT_THROUGHPUT = 50e6  # cells * timesteps / s
+DEFAULT_CONVERGE_INTERVAL = 10  # s
+DEFAULT_ADAPTIVE_POINTS = 20000  # farfield angles
+
+SIGNALS_SUFFIX = '.signals'
+RESULTS_SUFFIX = '.results'
+PARTIAL_SUFFIX = '.partial'
+FARFIELD_COUNT = 1e3  # a single --farfield-frequencies value below this is a count
+FARFIELD_STACKED = [ 'freq', 'Dmax', 'Prad', 'E_theta', 'E_phi', 'E_norm',
+    'E_cprh', 'E_cplh', 'P_rad' ]
+FARFIELD_GRID = [ 'E_theta', 'E_phi', 'E_norm', 'E_cprh', 'E_cplh', 'P_rad' ]
+ADAPTIVE_STEP = 15  # degree, starting grid, keeps the phi = 0 and 90 cuts
+ADAPTIVE_FLOOR = -40  # dB, pattern changes below this are not refined
+PROFILE_PHASES = [ 'unzip', 'load_models', 'mesh', 'write_polyhedra', 'csx', 'fdtd',
+    'calc_port', 'nf2ff', 'save' ]
+TRACE = []  # chrome trace events of --profile
+args = None  # options of the current run, from the command line or a Simulation
+
+SYMMETRY_TOL = .01  # mm
+PML_CELLS = 8
+PORT_TRANSFORMS = [ (0,), (1,), (2,), (1, 2), (0, 2), (0, 1), (0, 1, 2) ]
+DFT_CHUNK = 1024  # samples
+RINGDOWN_SAMPLES = 1200
+RINGDOWN_ORDER = 40
+
+CELL_MEMORY = 72  # bytes, float32 fields and update coefficients per cell
+DECAY_PER_PULSE = 10  # dB of energy decay per gaussian pulse length, low q estimate
+
+PRIMITIVES = [ 'degenerate', 'box', 'cylinder', 'extrusion', 'polyhedron' ]
+
+CACHE_VERSION = 2
+RESULT_OPTIONS = [ 'pitch', 'points', 'line', 'criteria', 'average',
+    'farfield', 'dphi', 'dtheta', 'nominimum', 'primitive_tol', 'snap',
+    'mesh', 'cells_per_wavelength', 'grading', 'converge', 'converge_interval',
+    'extrapolate', 'complex64', 'farfield_frequencies', 'adaptive', 'adaptive_points',
+    'symmetry', 'port_symmetry', 'airbox', 'pml', 'sheets' ]
 
 MATERIALS = {  # s/m
     'silver':   { "kappa": 62.1e6 },  
@@ -35,7 +95,7 @@ COLORS = {
 }
 
 
-def parse_args():
+def parse_args(argv=None):
     formatter_class = argparse.ArgumentDefaultsHelpFormatter
     parser = argparse.ArgumentParser(formatter_class=formatter_class)
     parser.add_argument('input_filename', nargs=1,
@@ -61,6 +121,28 @@ def parse_args():
     parser.add_argument('--line', type=float, default=DEFAULT_REFERENCE,
         help='default characteristic impedance of ports')
 
+    mesh_group = parser.add_argument_group("mesh options")
+    mesh_group.add_argument('--mesh', choices=[ 'uniform', 'graded' ], default='uniform',
+        help='uniform pitch everywhere, or pitch at conductor and port edges '
+             'graded up to a fraction of the wavelength')
+    mesh_group.add_argument('--cells-per-wavelength', type=float,
+        default=DEFAULT_CELLS_PER_WAVELENGTH,
+        help='largest graded cell as a fraction of the shortest wavelength')
+    mesh_group.add_argument('--grading', type=float, default=DEFAULT_GRADING,
+        help='maximum size ratio of neighboring cells')
+    mesh_group.add_argument('--sheets', action='store_true',
+        help='model metal boxes thinner than the pitch as conducting sheets')
+    mesh_group.add_argument('--symmetry', default='none',
+        help='simulate half or a quarter of the model, auto to detect the symmetry '
+             'planes through the model center, or the plane normals like x or xy')
+    mesh_group.add_argument('--snap', type=float, default=DEFAULT_SNAP,
+        help='merge mesh lines closer than this fraction of the pitch, '
+             'keeping the line of the higher priority part')
+    mesh_group.add_argument('--cell-ratio', type=float, default=DEFAULT_CELL_RATIO,
+        help='warn when the smallest cell is this many times less than the pitch')
+    mesh_group.add_argument('--strict-mesh', action='store_true',
+        help='stop instead of warning when the cell ratio is exceeded')
+
     pat_group = parser.add_argument_group("farfield options")
     pat_group.add_argument('--farfield', action='store_true', 
         help='generate free-space farfield radiation patterns')
@@ -70,6 +152,25 @@ def parse_args():
         help='elevation increment (degree)')
     pat_group.add_argument('--nominimum', action='store_true', 
         help='do not find frequency of least VWSR')
+    pat_group.add_argument('--farfield-frequencies', type=float, nargs='+',
+        metavar='FREQ',
+        help='farfield frequencies (Hz), or a single count of frequencies spread '
+             'over the sweep')
+    pat_group.add_argument('--farfield-jobs', type=int, default=1,
+        help='processes for the farfield frequencies, each reads the near field dumps '
+             'into memory and runs its own multithreaded nf2ff')
+    pat_group.add_argument('--airbox', type=float,
+        metavar='FRACTION',
+        help='pad the models with FRACTION of the longest wavelength of free space '
+             'instead of using the air models')
+    pat_group.add_argument('--pml', action='store_true',
+        help=f'use {PML_CELLS} cell PML absorbing boundaries instead of MUR')
+    pat_group.add_argument('--adaptive', type=float,
+        metavar='DB',
+        help='start from a coarse angle grid and refine it down to --dtheta and --dphi '
+             'where the pattern changes by more than DB between neighbours')
+    pat_group.add_argument('--adaptive-points', type=int, default=DEFAULT_ADAPTIVE_POINTS,
+        help='maximum number of farfield angles with --adaptive')
 
     sim_group = parser.add_argument_group("openems options")
     sim_group.add_argument('--criteria', type=float,
@@ -80,66 +181,263 @@ def parse_args():
         help='openems verbose setting')
     sim_group.add_argument('--threads', type=int, default=0,
         help='number of threads to use, 0 for all')
+    sim_group.add_argument('--jobs', type=int, default=1,
+        help='number of port excitations to run in parallel, sharing the threads')
+    sim_group.add_argument('--port-symmetry', action='store_true',
+        help='simulate one port of every set of ports that the mirrors and rotations '
+             'of the model map onto each other, and copy the other columns')
+    sim_group.add_argument('--converge', type=float,
+        metavar='TOL',
+        help='stop once consecutive s-parameter estimates differ by less than TOL')
+    sim_group.add_argument('--converge-interval', type=float,
+        default=DEFAULT_CONVERGE_INTERVAL,
+        help='seconds between s-parameter estimates with --converge')
+    sim_group.add_argument('--extrapolate', action='store_true',
+        help='continue the ringdown of the port signals with a matrix pencil fit')
+    sim_group.add_argument('--keep-signals', action='store_true',
+        help='keep the port signals next to the output file for the reprocess command')
+    sim_group.add_argument('--primitive-tol', type=float, default=DEFAULT_PRIMITIVE_TOL,
+        help='tolerance for replacing STL models by boxes, cylinders and '
+             'extrusions, as a fraction of the pitch, 0 to disable')
+    sim_group.add_argument('--workdir',
+        help='directory for the STL files read by openems, a temporary directory if not set')
+
+    store_group = parser.add_argument_group("output options")
+    store_group.add_argument('--store', choices=[ 'npz', 'npy' ], default='npz',
+        help='write a single .npz file, or a .results directory of .npy files '
+             'that can be memory mapped')
+    store_group.add_argument('--complex64', action='store_true',
+        help='store complex results in single precision')
+    store_group.add_argument('--restart', action='store_true',
+        help='discard the excitations finished by an earlier, interrupted run')
+
+    cache_group = parser.add_argument_group("cache options")
+    cache_group.add_argument('--no-cache', action='store_true',
+        help='do not read or write the result and geometry caches')
+    cache_group.add_argument('--cache-dir',
+        help='directory of cached results, $XDG_CACHE_HOME/rfems if not set')
+    cache_group.add_argument('--cache-size', type=float, default=DEFAULT_CACHE_SIZE,
+        help='maximum size of the result cache (MB)')
+    cache_group.add_argument('--geometry-cache-size', type=float,
+        default=DEFAULT_GEOMETRY_CACHE_SIZE,
+        help='maximum size of the parsed STL geometry cache (MB)')
 
     debug_group = parser.add_argument_group("debugging options")
+    debug_group.add_argument('--validate', action='store_true',
+        help='check the model names, port numbering and materials, without openems')
+    debug_group.add_argument('--dry-run', action='store_true',
+        help='estimate mesh size, timesteps, memory and runtime, no simulation')
     debug_group.add_argument('--show-model', action='store_true', 
         help='run AppCSXCAD on input model, no simulation')
     debug_group.add_argument('--dump-pec', action='store_true', 
         help='generate PEC dump file and run ParaView on it')
-    return parser.parse_args()
+    debug_group.add_argument('--profile',
+        metavar='FILE',
+        help='write the wall time and peak memory of every phase and excitation, '
+             'and the openems speed, to a chrome trace json file')
+    debug_group.add_argument('--cprofile', nargs='+', choices=PROFILE_PHASES, default=[],
+        metavar='PHASE',
+        help=f'run cProfile around these phases, one of {", ".join(PROFILE_PHASES)}, '
+             'written next to the --profile file')
+    return parser.parse_args(argv)
+
+
+def parse_reprocess_args(argv):
+    formatter_class = argparse.ArgumentDefaultsHelpFormatter
+    parser = argparse.ArgumentParser(prog='rfems.py reprocess',
+        formatter_class=formatter_class,
+        description='recalculate s-parameters from the port signals kept by --keep-signals')
+    parser.add_argument('input_filename', nargs=1,
+        help='port signal .npz file, or the .npz output file it was kept next to')
+    parser.add_argument('output_filename', nargs=1,
+        help='s-parameter .npz output file')
+    parser.add_argument('--frequency', type=float,
+        metavar='FREQ',
+        help='center frequency (Hz), the simulated one if not set')
+    parser.add_argument('--span', type=float,
+        help='frequency span (Hz), the simulated one if not set')
+    parser.add_argument('--points', type=int,
+        help='measurement frequency points, the simulated ones if not set')
+    parser.add_argument('--line', type=float,
+        help='characteristic impedance of all ports, the simulated ones if not set')
+    parser.add_argument('--zo', type=float, nargs='+',
+        help='characteristic impedance of every port, in port order')
+    parser.add_argument('--extrapolate', action='store_true',
+        help='continue the ringdown of the port signals with a matrix pencil fit')
+    parser.set_defaults(show_model=False, dump_pec=False)
+    return parser.parse_args(argv)
+
+
+class RfemsError(ValueError):
+    # a bad option or model, as opposed to a bug
+    pass
 
 
 def value_error(message):
-    print(f'ERROR: {message}.')
-    sys.exit(1)
+    # the command line prints the message, a Simulation caller can catch it
+    raise RfemsError(message)
+
+
+def is_binary_stl(buf):
+    if len(buf) < STL_HEADER + 4:
+        return False
+    count, = struct.unpack_from('<I', buf, STL_HEADER)
+    return len(buf) == STL_HEADER + 4 + count * STL_DTYPE.itemsize
+
+
+def parse_ascii_stl(buf):
+    tokens = np.array(buf.split())
+    ix = np.flatnonzero(tokens[:-3] == b'vertex')
+    data = tokens[ix[:,None] + np.arange(1, 4)].astype(np.float64)
+    if len(data) % 3:
+        raise ValueError('stl facets must have exactly three vertices')
+    return data.reshape(-1, 3, 3)
+
+
+def parse_binary_stl(buf):
+    count, = struct.unpack_from('<I', buf, STL_HEADER)
+    if count == 0:
+        return np.zeros((0, 3, 3))
+    facets = np.frombuffer(buf, dtype=STL_DTYPE, count=count, offset=STL_HEADER + 4)
+    data = facets['vertex'].astype(np.float64)
+
+    # binary stl stores float32 vertices, only 24 bits of mantissa,
+    # so the vertex spacing at the largest coordinate must resolve STL_TOL
+    extent = np.float32(np.max(np.abs(data)))
+    if np.spacing(extent) > STL_TOL:
+        raise ValueError('binary stl file has not enough precision')
+    return data
 
 
-def parse_stl(filename):
-    data = []
-    with open(filename, 'rb') as fp:
-        header = fp.read(5)
-        if header == b'solid':
-            facet = [] 
-            for ln in fp:
-                d = ln.split()
-                if d[0] == b'endfacet' and facet:
-                    data.append(np.array(facet))
-                    facet = []
-                if d[0] == b'vertex' and len(d) == 4:
-                    facet.append([ float(x) for x in d[1:] ])
-        else:
-            raise ValueError('binary stl files unsupported: not enough precision')
-    return data
+def parse_stl(buf):
+    if is_binary_stl(buf):
+        return parse_binary_stl(buf)
+    return parse_ascii_stl(bytes(buf))
 
 
 def model_bbox(data):
-    start = None
-    stop = None
-    for facet in data:
-        for v in facet:
-            start = v if start is None else np.minimum(v, start) 
-            stop = v if stop is None else np.maximum(v, stop)
-    return start, stop                 
+    return data.min(axis=(0, 1)), data.max(axis=(0, 1))
 
 
-def unzip_models(filename, dirname):
+def model_volume(data):
+    return np.sum(data[:,0] * np.cross(data[:,1], data[:,2])) / 6
+
+
+def polygon_area(points):
+    u, v = points
+    return (np.dot(u, np.roll(v, -1)) - np.dot(v, np.roll(u, -1))) / 2
+
+
+def vertex_keys(points):
+    return [ tuple(k) for k in np.round(points / STL_TOL).astype(np.int64) ]
+
+
+def cap_loop(data, axis, level, tol):
+    # chain the boundary edges of the cap facets into a single polygon
+    u, v = (axis + 1) % 3, (axis + 2) % 3
+    cap = data[np.all(np.abs(data[:,:,axis] - level) <= tol, axis=1)][:,:,[u, v]]
+    edges = {}
+    coords = {}
+    for tri in cap:
+        keys = vertex_keys(tri)
+        coords.update(zip(keys, tri))
+        for i in range(3):
+            a, b = keys[i], keys[(i + 1) % 3]
+            if (b, a) in edges:
+                del edges[b, a]
+            else:
+                edges[a, b] = True
+    succ = dict(edges.keys())
+    if not succ or len(succ) != len(edges):
+        return None
+    loop = [ next(iter(succ)) ]
+    while len(loop) <= len(succ):
+        k = succ.get(loop[-1])
+        if k is None or k == loop[0]:
+            break
+        loop.append(k)
+    if len(loop) != len(succ):
+        return None
+    return np.array([ coords[k] for k in loop ]).T
+
+
+def recognize_prism(data, start, stop, tol):
+    volume = abs(model_volume(data))
+    for axis in range(3):
+        u, v = (axis + 1) % 3, (axis + 2) % 3
+        vertex = data.reshape(-1, 3)
+        bottom = np.abs(vertex[:,axis] - start[axis]) <= tol
+        top = np.abs(vertex[:,axis] - stop[axis]) <= tol
+        if not np.all(bottom | top):
+            continue
+        if set(vertex_keys(vertex[bottom][:,[u, v]])) != set(vertex_keys(vertex[top][:,[u, v]])):
+            continue
+        points = cap_loop(data, axis, start[axis], tol)
+        if points is None:
+            continue
+        height = stop[axis] - start[axis]
+        if np.isclose(abs(polygon_area(points)) * height, volume, rtol=1e-3):
+            return axis, points
+    return None, None
+
+
+def recognize_cylinder(axis, points, tol):
+    # vertices on a circle and every edge within tol of its arc
+    center = points.mean(axis=1)
+    radius = np.max(np.hypot(*(points.T - center).T))
+    middle = (points + np.roll(points, -1, axis=1)) / 2
+    inner = np.hypot(*(middle.T - center).T)
+    vertex = np.hypot(*(points.T - center).T)
+    if np.all(radius - vertex <= STL_TOL) and np.all(radius - inner <= tol):
+        return center, radius
+    return None, None
+
+
+def classify_model(data, start, stop, tol):
+    if np.any(np.isclose(stop - start, 0)):
+        return { 'kind': 'degenerate' }
+    if tol <= 0:
+        return { 'kind': 'polyhedron' }
+    atol = max(tol, STL_TOL)
+    corner = np.isclose(data, start, atol=atol) | np.isclose(data, stop, atol=atol)
+    volume = np.prod(stop - start)
+    if np.all(corner) and np.isclose(abs(model_volume(data)), volume, rtol=1e-3):
+        return { 'kind': 'box' }
+    axis, points = recognize_prism(data, start, stop, tol)
+    if axis is None:
+        return { 'kind': 'polyhedron' }
+    center, radius = recognize_cylinder(axis, points, tol)
+    if center is not None:
+        p0 = np.array(start, dtype=np.float64)
+        p0[[(axis + 1) % 3, (axis + 2) % 3]] = center
+        p1 = p0.copy()
+        p1[axis] = stop[axis]
+        return { 'kind': 'cylinder', 'p0': p0, 'p1': p1, 'radius': radius }
+    return { 'kind': 'extrusion', 'axis': axis, 'points': points }
+
+
+def unzip_models(filename, read=True):
     root, ext = os.path.splitext(filename)
     if ext != '.zip':
         filename = f'{root}.zip'
-    zf = zipfile.ZipFile(filename)
+    # each member is decompressed once, then hashed, parsed and written from memory
     data = {}
-    for info in zf.infolist():
-        if not info.is_dir():
-            root, ext = os.path.splitext(info.filename)
-            if ext == '.stl':
-                name = os.path.basename(root)
-                path = zf.extract(info, dirname)
-                data[name] = path
-            else:
-                print(f'WARNING: ignoring {info.filename}, only .stl files allowed')
+    with zipfile.ZipFile(filename) as zf:
+        for info in zf.infolist():
+            if not info.is_dir():
+                root, ext = os.path.splitext(info.filename)
+                if ext == '.stl':
+                    name = os.path.basename(root)
+                    data[name] = zf.read(info) if read else info
+                else:
+                    print(f'WARNING: ignoring {info.filename}, only .stl files allowed')
     return data
 
 
+def hash_models(members):
+    return { k: hashlib.sha256(v).hexdigest() for k, v in members.items() }
+
+
 def get_material(name):
     return name.split('-')[-1].strip().lower()
 
@@ -219,6 +517,56 @@ def get_simports(models):
     return port_start, port_stop, nport
 
 
+def check_name(name):
+    # the problems get_simports and add_parts would stop on, or silently accept
+    data = get_material(name).split()
+    errors, warnings = [], []
+    if not data:
+        return [ 'no material provided' ], []
+    for d in data:
+        key, _, value = d.partition('=')
+        try:
+            if key in ('epsilon', 'kappa'): float(value)
+            if key in ('zo', 'priority'): int(value)
+        except ValueError:
+            errors.append(f'bad {key} value "{value}"')
+    if is_port(name):
+        numbers = [ n for n in map(toint, data) if n is not None ]
+        if not numbers:
+            errors.append('no port number provided')
+        elif numbers[0] <= 0:
+            errors.append('port number must be 1 or greater')
+        if not set(data) & { 'x', 'y', 'z' }:
+            errors.append('no port direction provided')
+    elif data[0] not in MATERIALS and data[0] not in ('pec', 'air') and \
+            not any(d.partition('=')[0] in ('epsilon', 'kappa') for d in data):
+        warnings.append(f'unknown material "{data[0]}", simulated as pec')
+    return errors, warnings
+
+
+def validate_models(members):
+    errors = 0
+    portnum = []
+    for name in sorted(members):
+        problems, warnings = check_name(name)
+        for message in warnings:
+            print(f'WARNING: {name}: {message}')
+        for message in problems:
+            print(f'ERROR: {name}: {message}.')
+        errors += len(problems)
+        if is_port(name) and not problems:
+            portnum.append(get_portnum(name))
+    nport = len([ k for k in members if is_port(k) ])
+    if nport == 0:
+        print('WARNING: No ports provided')
+    elif not errors and sorted(portnum) != list(range(1, nport + 1)):
+        print(f'ERROR: Ports must be numbered consecutive, found {", ".join(map(str, sorted(portnum)))}.')
+        errors += 1
+    if errors:
+        value_error('Invalid model names')
+    print(f'{len(members)} models, {nport} ports OK')
+
+
 def frequency_sweep():
     frequency = args.frequency
     span = args.span
@@ -233,7 +581,8 @@ def frequency_sweep():
     return frequency, span
 
 
-def setup_simulation(CSX):
+def setup_simulation(CSX, planes):
+    from openEMS import openEMS
     average = args.average
     fo, span = frequency_sweep()
     kw = {}
@@ -243,7 +592,9 @@ def setup_simulation(CSX):
         kw['NrTS'] = 0
     FDTD = openEMS(CellConstantMaterial=not average, **kw) 
     FDTD.SetGaussExcite(fo, span / 2)
-    boundary = [ 'MUR' if args.farfield else 'PEC' ] * 6
+    boundary = [ f'PML_{PML_CELLS}' if args.pml else 'MUR' if args.farfield else 'PEC' ] * 6
+    for axis, center, wall in planes:
+        boundary[2 * axis] = wall
     FDTD.SetBoundaryCond(boundary)
     FDTD.SetCSX(CSX)
     return FDTD
@@ -267,21 +618,504 @@ def run_appcsxcad(CSX, sim_path):
     sys.exit(0)
 
 
-def run_paraview():
-    os.system('paraview "PEC_dump.vtp"')
+def run_paraview(sim_path):
+    os.system('paraview "{}"'.format(os.path.join(sim_path, 'PEC_dump.vtp')))
     sys.exit(0)
 
 
+def reset_peak_rss():
+    # linux only, restarts the VmHWM high water mark of this process
+    try:
+        with open('/proc/self/clear_refs', 'w') as fp:
+            fp.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss(reset):
+    # MB, the peak of the phase after a reset, otherwise the peak of the process so far
+    if reset:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                if line.startswith('VmHWM:'):
+                    return 'peak_rss_mb', int(line.split()[1]) * 1024 / 1e6
+    if resource is None:
+        return None, None
+    # ru_maxrss is in bytes on macos and in kilobytes elsewhere
+    scale = 1 if platform.system() == 'Darwin' else 1024
+    return 'peak_rss_so_far_mb', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 1e6
+
+
+@contextlib.contextmanager
+def phase(name, n=None, info=None):
+    # a chrome trace complete event, info is filled in by the caller
+    if not args.profile:
+        yield {} if info is None else info
+        return
+    info = {} if info is None else info
+    label = name if n is None else f'{name} port {n + 1}'
+    profile = cProfile.Profile() if name in args.cprofile else None
+    reset = reset_peak_rss()
+    start = time.time()
+    if profile:
+        profile.enable()
+    try:
+        yield info
+    finally:
+        if profile:
+            profile.disable()
+            profile.dump_stats(f'{args.profile}.{label.replace(" ", "-")}.prof')
+        key, value = peak_rss(reset)
+        if key:
+            info[key] = value
+        TRACE.append({ 'name': label, 'cat': name, 'ph': 'X', 'pid': os.getpid(), 'tid': 0,
+            'ts': start * 1e6, 'dur': (time.time() - start) * 1e6, 'args': info })
+
+
+def write_trace(filename):
+    with open(filename, 'w') as fp:
+        json.dump({ 'traceEvents': TRACE, 'displayTimeUnit': 'ms' }, fp)
+    for event in TRACE:
+        info = event['args']
+        if 'peak_rss_mb' in info:
+            memory = f', peak {info["peak_rss_mb"]:.0f} MB'
+        elif 'peak_rss_so_far_mb' in info:
+            memory = f', peak so far {info["peak_rss_so_far_mb"]:.0f} MB'
+        else:
+            memory = ''
+        print(f'{event["name"]}: {event["dur"] / 1e6:.3f} s{memory}')
+    print(f'Profile written to {filename}')
+
+
+@contextlib.contextmanager
+def capture_output(filename):
+    # tee the native openems output to a log, it bypasses sys.stdout
+    sys.stdout.flush()
+    saved = os.dup(1)
+    read, write = os.pipe()
+    os.dup2(write, 1)
+    os.close(write)
+
+    def tee():
+        with open(filename, 'wb') as log:
+            while chunk := os.read(read, 65536):
+                os.write(saved, chunk)
+                log.write(chunk)
+    thread = threading.Thread(target=tee, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved, 1)
+        thread.join()
+        os.close(read)
+        os.close(saved)
+
+
+def parse_openems_log(filename):
+    # timesteps, cells and speed from the summary openems prints at the end
+    with open(filename, errors='replace') as fp:
+        text = fp.read()
+    result = {}
+    match = re.findall(r'Time for (\d+) iterations with (\d+) cells', text)
+    if match:
+        result['timesteps'], result['cells'] = map(int, match[-1])
+    match = re.findall(r'Speed:\s*([\d.]+) MCells/s', text)
+    if match:
+        result['speed'] = float(match[-1]) * 1e6
+    return result
+
+
 def run_simulation(FDTD, sim_path):
     threads = max(0, args.threads)
     verbose = args.verbose
     dump_pec = args.dump_pec
-    FDTD.Run(sim_path, verbose=verbose, numThreads=threads, debug_pec=dump_pec)
+    # openems changes into sim_path, relative paths of the caller must keep working
+    cwd = os.getcwd()
+    try:
+        FDTD.Run(sim_path, verbose=verbose, numThreads=threads, debug_pec=dump_pec)
+    finally:
+        os.chdir(cwd)
 
 
-def calc_sparameters(ports, s, n):
-    for m in range(len(ports)):
-        s[:,m,n] = ports[m].uf_ref / ports[n].uf_inc
+
+def read_signal(filename):
+    # time and value columns of an openems probe, skips an unfinished last line
+    with open(filename, 'rb') as fp:
+        buf = fp.read()
+    start = 0
+    while buf.startswith(b'%', start):
+        start = buf.index(b'\n', start) + 1
+    buf = buf[start:buf.rfind(b'\n') + 1]
+    data = np.array(buf.split()).astype(np.float64)
+    return data[:len(data) // 2 * 2].reshape(-1, 2).T
+
+
+def read_ports(sim_path, nport):
+    signals = []
+    for k in range(1, nport + 1):
+        tu, u = read_signal(os.path.join(sim_path, f'port_ut{k}'))
+        ti, i = read_signal(os.path.join(sim_path, f'port_it{k}'))
+        signals.append((tu, u, ti, i))
+    return signals
+
+
+def is_uniform(frequency):
+    if len(frequency) < 3:
+        return False
+    step = np.diff(frequency)
+    return np.allclose(step, step[0], rtol=1e-9, atol=0)
+
+
+def czt(t, x, frequency):
+    # bluestein chirp-z zoom transform onto the uniform frequency grid,
+    # nk = (n^2 + k^2 - (k - n)^2) / 2 turns the dft into a convolution
+    N = x.shape[-1]
+    M = len(frequency)
+    dt = (t[-1] - t[0]) / (N - 1)
+    alpha = (frequency[1] - frequency[0]) * dt
+    n = np.arange(N)
+    k = np.arange(M)
+    size = 1 << int(np.ceil(np.log2(N + M - 1)))
+    kernel = np.zeros(size, dtype=np.complex128)
+    kernel[:M] = np.exp(1j * np.pi * alpha * k ** 2)
+    kernel[size - N + 1:] = np.exp(1j * np.pi * alpha * n[:0:-1] ** 2)
+    y = x * np.exp(-2j * np.pi * frequency[0] * dt * n - 1j * np.pi * alpha * n ** 2)
+    X = np.fft.ifft(np.fft.fft(y, size) * np.fft.fft(kernel))[...,:M]
+    return X * np.exp(-1j * np.pi * alpha * k ** 2 - 2j * np.pi * frequency * t[0])
+
+
+def dft(t, x, frequency):
+    # single sided spectra of pulses sampled at t, like openems DFT_time2freq
+    if is_uniform(frequency) and len(t) > 1:
+        X = czt(t, x, frequency)
+    else:
+        X = np.zeros(np.shape(x)[:-1] + (len(frequency),), dtype=np.complex128)
+        for k in range(0, len(t), DFT_CHUNK):
+            w = np.exp(-2j * np.pi * np.outer(frequency, t[k:k + DFT_CHUNK]))
+            X += x[...,k:k + DFT_CHUNK] @ w.T
+    return 2 * (t[1] - t[0]) * X
+
+
+def ringdown(t, x, frequency):
+    # spectrum of the signal continued past its end by a matrix pencil fit
+    tail = x[-RINGDOWN_SAMPLES:]
+    if len(tail) < 10 or not np.any(tail):
+        return 0
+    L = len(tail) // 3
+    Y = np.lib.stride_tricks.sliding_window_view(tail, L + 1)
+    sv, Vh = np.linalg.svd(Y, full_matrices=False)[1:]
+    order = min(RINGDOWN_ORDER, np.sum(sv > sv[0] * 1e-8))
+    V = Vh[:order].conj().T
+    poles = np.linalg.eigvals(np.linalg.pinv(V[:-1]) @ V[1:])
+    poles = poles[np.abs(poles) < 1]
+    A = poles[None,:] ** np.arange(len(tail))[:,None]
+    amplitude = np.linalg.lstsq(A, tail.astype(np.complex128), rcond=None)[0]
+    dt = t[1] - t[0]
+    w = np.exp(-2j * np.pi * frequency * dt)
+    end = amplitude * poles ** len(tail)
+    X = np.sum(end[None,:] / (1 - poles[None,:] * w[:,None]), axis=1)
+    X = 2 * dt * np.exp(-2j * np.pi * frequency * (t[-1] + dt)) * X
+    return X
+
+
+def port_spectra(signals, frequency, extrapolate=False):
+    # voltage and current spectra of all ports, one transform per time base
+    series = [ x[:2] for x in signals ] + [ x[2:] for x in signals ]
+    groups = {}
+    for k, (t, v) in enumerate(series):
+        groups.setdefault((len(t), t[0], t[-1]), []).append(k)
+    spectra = [ None ] * len(series)
+    for ix in groups.values():
+        t = series[ix[0]][0]
+        X = dft(t, np.array([ series[k][1] for k in ix ]), frequency)
+        for k, row in zip(ix, X):
+            spectra[k] = (row + ringdown(t, series[k][1], frequency)) if extrapolate else row
+    return spectra[:len(signals)], spectra[len(signals):]
+
+
+def calc_column(signals, z, n, frequency, extrapolate=False):
+    uf, jf = port_spectra(signals, frequency, extrapolate)
+    inc = [ (u + i * zo) / 2 for u, i, zo in zip(uf, jf, z) ]
+    ref = [ u - a for u, a in zip(uf, inc) ]
+    return np.array([ r / inc[n] for r in ref ]).T
+
+
+def signals_filename(filename):
+    root, ext = os.path.splitext(filename)
+    if root.endswith(SIGNALS_SUFFIX):
+        return f'{root}.npz'
+    return f'{root}{SIGNALS_SUFFIX}.npz'
+
+
+def pack_signals(signals, n):
+    # uniform time axis as start and step, float32 samples
+    packed = {}
+    for k, (tu, u, ti, i) in enumerate(signals):
+        packed[f'tu{n}_{k}'] = np.array([ tu[0], (tu[-1] - tu[0]) / max(1, len(tu) - 1) ])
+        packed[f'ti{n}_{k}'] = np.array([ ti[0], (ti[-1] - ti[0]) / max(1, len(ti) - 1) ])
+        packed[f'u{n}_{k}'] = u.astype(np.float32)
+        packed[f'i{n}_{k}'] = i.astype(np.float32)
+    return packed
+
+
+def unpack_signals(archive, n, nport):
+    signals = []
+    for k in range(nport):
+        u = archive[f'u{n}_{k}'].astype(np.float64)
+        i = archive[f'i{n}_{k}'].astype(np.float64)
+        tu = archive[f'tu{n}_{k}']
+        ti = archive[f'ti{n}_{k}']
+        tu = tu[0] + tu[1] * np.arange(len(u))
+        ti = ti[0] + ti[1] * np.arange(len(i))
+        signals.append((tu, u, ti, i))
+    return signals
+
+
+def save_signals(filename, signals, z, scale, excitations, derived, key, done):
+    # derived columns as rows of n, m, perm and sign
+    filename = signals_filename(filename)
+    sweep = frequency_sweep() + (args.points,)
+    excitations = list(excitations)
+    rows = [ [ n, m ] + list(perm) + list(sign) for n, (m, perm, sign) in derived.items() ]
+    if done:
+        # a resumed run adds its excitations to the archive of the earlier runs
+        kept = set()
+        if os.path.exists(filename):
+            with np.load(filename) as archive:
+                if 'key' in archive and str(archive['key']) == key:
+                    previous = [ int(n) for n in archive['excitations'] if n in done ]
+                    signals = { **{ f'{x}{n}_{k}': archive[f'{x}{n}_{k}'] for n in previous
+                                    for k in range(len(z)) for x in ('tu', 'ti', 'u', 'i') }, **signals }
+                    excitations = sorted(previous + excitations)
+                    old = [ list(row) for row in archive['derived'] if row[0] in done ]
+                    rows = sorted(old + rows)
+                    kept = set(previous) | { row[0] for row in old }
+        missing = sorted(set(done) - kept)
+        if missing:
+            print(f'WARNING: no signals kept for port excitations {", ".join(str(n + 1) for n in missing)}')
+    np.savez_compressed(filename, sweep=sweep, z=z, scale=scale, key=key,
+        excitations=np.array(excitations, dtype=np.int64),
+        derived=np.array(rows, dtype=np.int64).reshape(-1, 2 + 2 * len(z)), **signals)
+
+
+def monitor_convergence(sim_path, z, n, frequency, pulse, tol, interval):
+    previous, last = None, None
+    while True:
+        time.sleep(interval)
+        try:
+            signals = read_ports(sim_path, len(z))
+        except (OSError, ValueError):
+            continue
+        if min(len(x[0]) for x in signals) < 2 or signals[n][0][-1] < pulse:
+            continue
+        # only compare estimates while openems is still writing the probes
+        if last is not None and signals[n][0][-1] <= last:
+            continue
+        last = signals[n][0][-1]
+        s = calc_column(signals, z, n, frequency)
+        if previous is not None and np.max(np.abs(s - previous)) < tol:
+            open(os.path.join(sim_path, 'ABORT'), 'w').close()
+            return
+        previous = s
+
+
+def clear_probes(sim_path, nport):
+    # a sequential run reuses sim_path, the probes of the previous
+    # excitation would look converged to the monitor
+    names = [ 'ABORT' ] + [ f'port_{x}t{k}' for k in range(1, nport + 1) for x in 'ui' ]
+    for name in names:
+        if os.path.exists(os.path.join(sim_path, name)):
+            os.remove(os.path.join(sim_path, name))
+
+
+def start_monitor(sim_path, z, n, frequency):
+    fo, span = frequency_sweep()
+    pulse = 9 / (np.pi * span / 2)
+    monitor = Process(target=monitor_convergence, args=(sim_path, z, n, frequency,
+        pulse, args.converge, args.converge_interval), daemon=True)
+    monitor.start()
+    return monitor
+
+
+def report_convergence(signals):
+    # decay rate of the port signal energy, a stand in for the field energy
+    criteria = args.criteria or DEFAULT_CRITERIA
+    size = min(len(x[1]) for x in signals)
+    t = signals[0][0][:size]
+    dt = t[1] - t[0]  # the probes record every openems timestep
+    energy = np.sum([ x[1][:size] ** 2 for x in signals ], axis=0)
+    windows = np.array_split(np.arange(size), 40)
+    level = np.array([ np.sum(energy[w]) for w in windows ])
+    level = 10 * np.log10(level / np.max(level) + 1e-300)
+    middle = np.array([ t[w].mean() for w in windows ])
+    peak = np.argmax(level)
+    if len(windows) - peak < 4:
+        return
+    slope = np.polyfit(middle[peak:], level[peak:], 1)[0]
+    saved = 0
+    if slope < 0 and level[-1] > criteria:
+        saved = int((criteria - level[-1]) / slope / dt)
+    print(f'Converged at {t[-1] * 1e9:.4g} ns and {level[-1]:.1f} dB, '
+          f'about {saved} timesteps before the {criteria} dB end criteria')
+
+
+def farfield_frequencies(s, n):
+    frequency = get_frequencies()
+    values = args.farfield_frequencies
+    if values and len(values) == 1 and values[0] < FARFIELD_COUNT:
+        fo, span = frequency_sweep()
+        count = max(1, int(values[0]))
+        return np.linspace(fo - span / 2, fo + span / 2, count) if count > 1 else np.array([ fo ])
+    if values:
+        return np.array(values)
+    if not args.nominimum:
+        ix = np.argmin(np.abs(s[:,n,n]))
+        frequency = np.array([ frequency[ix] or frequency_sweep()[0] ])
+    return frequency
+
+
+def nf2ff_worker(sim_path, box, frequency, theta, phi, outfile):
+    # a throwaway CSX, the nf2ff only needs the name and size of the dump box
+    from openEMS.nf2ff import nf2ff as NF2FF
+    from CSXCAD import ContinuousStructure
+    name, start, stop, kw = box
+    nf2ff = NF2FF(ContinuousStructure(), name, start, stop, **kw)
+    res = nf2ff.CalcNF2FF(sim_path, frequency, theta, phi, outfile=outfile)
+    return dict(res.__dict__)
+
+
+def merge_farfield(results):
+    ff = dict(results[0])
+    for key in FARFIELD_STACKED:
+        ff[key] = np.concatenate([ np.asarray(res[key]) for res in results ])
+    return ff
+
+
+def calc_nf2ff(sim_path, nf2ff, frequency, theta, phi):
+    # a single call reads the near field dumps once for all frequencies
+    jobs = min(args.farfield_jobs, len(frequency))
+    if jobs <= 1:
+        res = nf2ff.CalcNF2FF(sim_path, frequency, theta, phi)
+        return dict(res.__dict__)
+
+    # every worker reads the near field dumps again for its share of the frequencies
+    box = (nf2ff.name, nf2ff.start, nf2ff.stop,
+           { 'directions': nf2ff.directions, 'mirror': nf2ff.mirror })
+    with ProcessPoolExecutor(jobs) as pool:
+        futures = [ pool.submit(nf2ff_worker, sim_path, box, chunk, theta, phi, f'nf2ff_{k}.h5')
+                    for k, chunk in enumerate(np.array_split(frequency, jobs)) ]
+        results = [ fut.result() for fut in futures ]
+    return merge_farfield(results)
+
+
+def pattern_db(ff):
+    # floor the nulls, otherwise numerical noise is refined forever
+    E = np.abs(np.asarray(ff['E_norm']))
+    E = E / np.maximum(E.max(axis=(1, 2), keepdims=True), np.finfo(float).tiny)
+    return np.maximum(20 * np.log10(np.maximum(E, 1e-12)), ADAPTIVE_FLOOR)
+
+
+def refine_angles(angles, db, axis, step, period, edge):
+    # midpoints of the intervals where the pattern changes too much,
+    # edge is the pattern at angles[0] + period to close the last interval
+    other = tuple(k for k in range(3) if k != axis)
+    db = np.concatenate([ db, edge ], axis=axis)
+    angles = np.append(angles, angles[0] + period)
+    change = np.abs(np.diff(db, axis=axis)).max(axis=other)
+    width = np.diff(angles)
+    ix = (change > args.adaptive) & (width >= 2 * step - 1e-9)
+    return angles[:-1][ix] + width[ix] / 2
+
+
+def merge_grid(ff, extra, angles, new, axis):
+    angles = np.concatenate([ angles, new ])
+    order = np.argsort(angles)
+    ff = dict(ff)
+    for key in FARFIELD_GRID:
+        ff[key] = np.concatenate([ np.asarray(ff[key]), np.asarray(extra[key]) ], axis=axis)
+        ff[key] = np.take(ff[key], order, axis=axis)
+    key = 'theta' if axis == 1 else 'phi'
+    ff[key] = np.deg2rad(angles[order])
+    return ff, angles[order]
+
+
+def integrate_farfield(ff):
+    # trapezoid rule on the nonuniform grid, closed around the sphere
+    theta = np.asarray(ff['theta'])
+    phi = np.asarray(ff['phi'])
+    P = np.asarray(ff['P_rad'])
+    r = np.asarray(ff['r'])
+    P = np.concatenate([ P, P[:,:1,:] ], axis=1)
+    theta = np.append(theta, theta[0] + 2 * np.pi)
+    # phi = 180 is phi = 0 mirrored in theta
+    edge = np.array([ np.interp(-theta, theta, p[:,0], period=2 * np.pi) for p in P ])
+    P = np.concatenate([ P, edge[:,:,None] ], axis=2)
+    phi = np.append(phi, np.pi)
+    integrand = P * np.abs(np.sin(theta))[None,:,None]
+    Prad = r ** 2 * np.trapezoid(np.trapezoid(integrand, phi, axis=2), theta, axis=1)
+    Dmax = 4 * np.pi * r ** 2 * P.max(axis=(1, 2)) / Prad
+    return Dmax, Prad
+
+
+def beamwidth(ff):
+    # half power width of the main lobe in the xz and yz planes
+    theta = np.rad2deg(np.asarray(ff['theta']))
+    phi = np.rad2deg(np.asarray(ff['phi']))
+    db = pattern_db(ff)
+    width = np.full((len(db), 2), np.nan)
+    for k, plane in enumerate([ 0, 90 ]):
+        ix = np.where(np.isclose(phi, plane))[0]
+        if len(ix) == 0:
+            continue
+        # the theta cut is a full circle, search it periodically
+        size = len(theta)
+        angles = np.concatenate([ theta - 360, theta, theta + 360 ])
+        for m, cut in enumerate(db[:,:,ix[0]]):
+            peak = np.argmax(cut) + size
+            cut = np.tile(cut, 3)
+            left = right = None
+            for j in range(peak, peak - size + 1, -1):
+                if cut[j - 1] < cut[peak] - 3:
+                    left = np.interp(cut[peak] - 3, [ cut[j - 1], cut[j] ], [ angles[j - 1], angles[j] ])
+                    break
+            for j in range(peak, peak + size - 1):
+                if cut[j + 1] < cut[peak] - 3:
+                    right = np.interp(cut[peak] - 3, [ cut[j + 1], cut[j] ], [ angles[j + 1], angles[j] ])
+                    break
+            if left is not None and right is not None:
+                width[m, k] = right - left
+    return width
+
+
+def adaptive_radiation(sim_path, nf2ff, frequency):
+    # coarse grid first, then halve the steps where the pattern changes fast
+    theta = np.arange(-180.0, 180.0, ADAPTIVE_STEP)
+    phi = np.arange(0, 180.0, ADAPTIVE_STEP)
+    ff = calc_nf2ff(sim_path, nf2ff, frequency, theta, phi)
+    calls = 1
+    while True:
+        db = pattern_db(ff)
+        # phi = 180 is phi = 0 mirrored in theta
+        edge = np.array([ np.interp(-theta, theta, d[:,0], period=360) for d in db ])
+        new_phi = refine_angles(phi, db, 2, args.dphi, 180, edge[:,:,None])
+        new_theta = refine_angles(theta, db, 1, args.dtheta, 360, db[:,:1,:])
+        points = (len(theta) + len(new_theta)) * (len(phi) + len(new_phi))
+        if len(new_theta) + len(new_phi) == 0 or points > args.adaptive_points:
+            break
+        if len(new_phi):
+            extra = calc_nf2ff(sim_path, nf2ff, frequency, theta, new_phi)
+            ff, phi = merge_grid(ff, extra, phi, new_phi, 2)
+            calls += 1
+        if len(new_theta):
+            extra = calc_nf2ff(sim_path, nf2ff, frequency, new_theta, phi)
+            ff, theta = merge_grid(ff, extra, theta, new_theta, 1)
+            calls += 1
+    ff['Dmax'], ff['Prad'] = integrate_farfield(ff)
+    print(f'Farfield: {len(theta)} x {len(phi)} adaptive grid from {calls} nf2ff calculations')
+    return ff
 
 
 def calc_radiation(sim_path, s, n, nf2ff):
@@ -289,20 +1123,221 @@ def calc_radiation(sim_path, s, n, nf2ff):
     dtheta = args.dtheta
     theta = np.arange(-180.0, 180.0, dtheta)
     phi = np.arange(0, 180, dphi)
-    frequency = get_frequencies()
-    if not args.nominimum:
-        ix = np.argmin(np.abs(s[:,n,n]))
-        frequency = frequency[ix] or frequency_sweep()[0]
-    res = nf2ff.CalcNF2FF(sim_path, frequency, theta, phi)
-    res = dict(res.__dict__)
-    return res
+    frequency = farfield_frequencies(s, n)
+    if args.adaptive:
+        ff = adaptive_radiation(sim_path, nf2ff, frequency)
+    else:
+        ff = calc_nf2ff(sim_path, nf2ff, frequency, theta, phi)
+    ff['beamwidth'] = beamwidth(ff)
+    for f, d, (xz, yz) in zip(ff['freq'], ff['Dmax'], ff['beamwidth']):
+        print(f'Farfield {f / 1e6:.3f} MHz: Dmax {10 * np.log10(d):.2f} dBi, '
+              f'beamwidth xz-plane {xz:.1f} deg, yz-plane {yz:.1f} deg')
+    return ff
 
 
-def save_results(filename, f, s, z, ff):
+def npz_filename(filename):
     root, ext = os.path.splitext(filename)
     if ext != '.npz':
         filename = f'{root}.npz'
-    np.savez(filename, f=f, s=s, z=z, **ff)
+    return filename
+
+
+def save_results(filename, f, s, z, ff):
+    np.savez(npz_filename(filename), f=f, s=s, z=z, **ff)
+
+
+def store_dirname(filename):
+    root, ext = os.path.splitext(npz_filename(filename))
+    suffix = RESULTS_SUFFIX if args.store == 'npy' else PARTIAL_SUFFIX
+    return f'{root}{suffix}'
+
+
+def load_results(filename, mmap=True):
+    # a .npz file or a .results directory of .npy files
+    root, ext = os.path.splitext(filename)
+    if ext == RESULTS_SUFFIX or os.path.isdir(filename):
+        dirname = filename
+    elif os.path.isdir(f'{root}{RESULTS_SUFFIX}') and not os.path.exists(npz_filename(filename)):
+        dirname = f'{root}{RESULTS_SUFFIX}'
+    else:
+        with np.load(npz_filename(filename)) as results:
+            return dict(results)
+    mmap_mode = 'r' if mmap else None
+    results = {}
+    for name in sorted(os.listdir(dirname)):
+        key, ext = os.path.splitext(name)
+        if ext == '.npy':
+            results[key] = np.load(os.path.join(dirname, name), mmap_mode=mmap_mode)
+    return results
+
+
+def read_meta(dirname):
+    with open(os.path.join(dirname, 'meta.json')) as f:
+        return json.load(f)
+
+
+def write_meta(dirname, meta):
+    # replace atomically, a crash leaves the previous state
+    filename = os.path.join(dirname, 'meta.json')
+    with open(f'{filename}.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(f'{filename}.tmp', filename)
+
+
+def store_array(value):
+    value = np.asarray(value)
+    if args.complex64 and value.dtype == np.complex128:
+        value = value.astype(np.complex64)
+    return value
+
+
+def resume_store(dirname, key, requested):
+    # finished excitations of an earlier run with the same model and options
+    try:
+        meta = read_meta(dirname)
+    except (OSError, ValueError):
+        return None
+    if args.restart or meta.get('key') != key:
+        return None
+    done = set(meta['excitations'])
+    if meta.get('finished'):
+        # the earlier run was not interrupted, only the ports it did not
+        # cover are kept and the requested ones are simulated again
+        done -= requested
+    meta.update(finished=False, requested=sorted(requested))
+    write_meta(dirname, meta)
+    return done
+
+
+def open_store(dirname, f, z, nport, key, requested):
+    # s is zero filled on disk and written a column at a time
+    done = resume_store(dirname, key, requested)
+    if done is not None:
+        return done
+    if os.path.exists(dirname):
+        shutil.rmtree(dirname)
+    os.makedirs(dirname)
+    np.save(os.path.join(dirname, 'f.npy'), f)
+    np.save(os.path.join(dirname, 'z.npy'), np.array(z))
+    dtype = np.complex64 if args.complex64 else np.complex128
+    s = open_memmap(os.path.join(dirname, 's.npy'), mode='w+',
+                    dtype=dtype, shape=(len(f), nport, nport))
+    del s
+    write_meta(dirname, { 'key': key, 'complete': False, 'finished': False,
+                          'requested': sorted(requested), 'excitations': [] })
+    return set()
+
+
+def store_column(dirname, n, column, ff):
+    s = open_memmap(os.path.join(dirname, 's.npy'), mode='r+')
+    s[:,:,n] = column
+    s.flush()
+    del s
+    for key, value in ff.items():
+        np.save(os.path.join(dirname, f'{key}.npy'), store_array(value))
+    meta = read_meta(dirname)
+    meta['excitations'] = sorted(set(meta['excitations']) | { int(n) })
+    write_meta(dirname, meta)
+
+
+def derive_columns(dirname, derived):
+    s = open_memmap(os.path.join(dirname, 's.npy'), mode='r')
+    columns = { n: permute_column(np.array(s[:,:,m]), m, perm, sign)
+                for n, (m, perm, sign) in derived.items() }
+    del s
+    for n, column in columns.items():
+        store_column(dirname, n, column, {})
+
+
+def remove_stale(filename, store):
+    # an output of the other store format from an earlier run would be
+    # read instead of, or mistaken for, this one
+    root, ext = os.path.splitext(npz_filename(filename))
+    if store == 'npy' and os.path.exists(f'{root}.npz'):
+        os.remove(f'{root}.npz')
+    if store == 'npz' and os.path.isdir(f'{root}{RESULTS_SUFFIX}'):
+        shutil.rmtree(f'{root}{RESULTS_SUFFIX}')
+
+
+def finish_store(dirname, filename, nport):
+    # keep a partial store until every port has been excited
+    meta = read_meta(dirname)
+    meta['complete'] = len(meta['excitations']) == nport
+    meta['finished'] = True
+    write_meta(dirname, meta)
+    if args.store == 'npz':
+        np.savez(npz_filename(filename), **load_results(dirname, mmap=False))
+        if meta['complete']:
+            shutil.rmtree(dirname)
+    remove_stale(filename, args.store)
+
+
+def unpack_store(dirname, filename):
+    if os.path.exists(dirname):
+        shutil.rmtree(dirname)
+    os.makedirs(dirname)
+    for key, value in load_results(filename, mmap=False).items():
+        np.save(os.path.join(dirname, f'{key}.npy'), value)
+    write_meta(dirname, { 'complete': True, 'excitations': [] })
+
+
+def cache_dir(*names):
+    root = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    dirname = args.cache_dir or os.path.join(root, 'rfems')
+    return os.path.join(dirname, *names)
+
+
+def use_cache():
+    if args.show_model or args.dump_pec or args.dry_run or args.keep_signals:
+        return False
+    return not args.no_cache
+
+
+def result_key(digests, port_start, port_stop):
+    options = { k: getattr(args, k) for k in RESULT_OPTIONS }
+    options['sweep'] = frequency_sweep()
+    options['ports'] = [ port_start, port_stop ]
+    options['version'] = CACHE_VERSION
+    h = hashlib.sha256(json.dumps(options, sort_keys=True).encode())
+    for name in sorted(digests.keys()):
+        h.update(name.encode())
+        h.update(digests[name].encode())
+    return h.hexdigest()
+
+
+def evict_cache(dirname, size):
+    entries = [ os.path.join(dirname, k) for k in os.listdir(dirname) ]
+    entries = sorted(entries, key=os.path.getmtime, reverse=True)
+    total = 0
+    for path in entries:
+        total += os.path.getsize(path)
+        if total > size * 1e6:
+            os.remove(path)
+
+
+def fetch_result(key, filename):
+    path = cache_dir('results', f'{key}.npz')
+    if not os.path.exists(path):
+        return False
+    os.utime(path)
+    if args.store == 'npy':
+        unpack_store(store_dirname(filename), path)
+    else:
+        shutil.copyfile(path, npz_filename(filename))
+    remove_stale(filename, args.store)
+    print(f'Using cached result {key[:12]}')
+    return True
+
+
+def store_result(key, filename):
+    dirname = cache_dir('results')
+    os.makedirs(dirname, exist_ok=True)
+    path = os.path.join(dirname, f'{key}.npz')
+    if args.store == 'npy':
+        np.savez(path, **load_results(store_dirname(filename), mmap=False))
+    else:
+        shutil.copyfile(npz_filename(filename), path)
+    evict_cache(dirname, args.cache_size)
 
 
 def is_applesilicon():
@@ -311,22 +1346,425 @@ def is_applesilicon():
 
 #####################
 
+def flatten_bbox(start, stop):
+    # handle <3d surfaces
+    ix = np.logical_or(stop - start < STL_TOL, np.isclose(stop - start, STL_TOL))
+    start[ix] = stop[ix] = ((start + stop) / 2)[ix]
+    return start, stop
+
+
+def parse_model(buf):
+    tol = args.primitive_tol * args.pitch / STL_UNIT
+    data = parse_stl(buf)
+    start, stop = flatten_bbox(*model_bbox(data))
+    model = { 'data': data, 'start': start, 'stop': stop }
+    model.update(classify_model(data, start, stop, tol))
+    return model
+
+
+def load_model(member, digest, stats):
+    if args.no_cache:
+        return parse_model(member)
+    tol = args.primitive_tol * args.pitch
+    key = hashlib.sha256(f'{CACHE_VERSION} {tol} {digest}'.encode()).hexdigest()
+    filename = cache_dir('geometry', f'{key}.npz')
+    if os.path.exists(filename):
+        stats['hits'] += 1
+        os.utime(filename)
+        with np.load(filename) as entry:
+            model = { k: entry[k] for k in entry.files }
+        model['kind'] = str(model['kind'])
+        if 'axis' in model:
+            model['axis'] = int(model['axis'])
+        return model
+    stats['misses'] += 1
+    model = parse_model(member)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tempname = f'{filename}.{os.getpid()}.npz'
+    np.savez(tempname, **model)
+    os.replace(tempname, filename)
+    return model
+
+
+def load_models(members, digests):
+    stats = { 'hits': 0, 'misses': 0 }
+    geometry = {}
+    for name, member in members.items():
+        geometry[name] = load_model(member, digests[name], stats)
+    if not args.no_cache:
+        print('Geometry cache: {hits} hits, {misses} misses'.format(**stats))
+        evict_cache(cache_dir('geometry'), args.geometry_cache_size)
+    kinds = [ v['kind'] for k, v in geometry.items() if not is_port(k) ]
+    kinds = [ f'{kinds.count(k)} {k}' for k in PRIMITIVES if k in kinds ]
+    print(f'Primitives: {", ".join(kinds)}')
+    return geometry
+
+
+def write_polyhedra(models, members, digests, dirname):
+    # only polyhedra are read back from disk by CSXCAD
+    for name, model in models.items():
+        if model['kind'] == 'polyhedron' and not is_port(name):
+            path = os.path.join(dirname, f'{digests[name]}.stl')
+            if not os.path.exists(path):
+                os.makedirs(dirname, exist_ok=True)
+                with open(path, 'wb') as fp:
+                    fp.write(members[name])
+            model['path'] = path
+
+
+def is_conductor(name):
+    material = get_material(name)
+    tag = material.split()[0]
+    if tag == 'air':
+        return False
+    return 'epsilon' not in get_custom_material(material)
+
+
+def is_air(name):
+    return get_material(name).split()[0] == 'air'
+
+
+def model_bounds(models):
+    # extent of the models, without air with --airbox
+    parts = [ m for k, m in models.items() if not is_port(k) and not (args.airbox and is_air(k)) ]
+    return np.min([ m['start'] for m in parts ], axis=0), np.max([ m['stop'] for m in parts ], axis=0)
+
+
+def free_space():
+    # a fraction of the longest wavelength
+    fo, span = frequency_sweep()
+    frequency = get_frequencies()
+    lowest = np.min(frequency[frequency > 0], initial=fo)
+    return args.airbox * C0 / lowest / STL_UNIT
+
+
+def air_padding():
+    # free space plus the cells taken by the pml
+    fo, span = frequency_sweep()
+    padding = free_space()
+    if args.pml:
+        cell = args.pitch / STL_UNIT
+        if args.mesh == 'graded':
+            cell = max(cell, C0 / (fo + span / 2) / STL_UNIT / args.cells_per_wavelength)
+        padding += PML_CELLS * cell
+    return padding
+
+
+def domain_bounds(models):
+    start, stop = model_bounds(models)
+    if args.airbox:
+        padding = air_padding()
+        start, stop = start - padding, stop + padding
+    return start, stop
+
+
+def nf2ff_bounds(models, planes):
+    # halfway between the models and the edge of the air padding
+    start, stop = model_bounds(models)
+    gap = free_space() / 2
+    start, stop = start - gap, stop + gap
+    for axis, center, wall in planes:
+        start[axis] = center
+    return start, stop
+
+
+def model_center(models):
+    start, stop = domain_bounds(models)
+    return (start + stop) / 2
+
+
+def point_set(points):
+    return np.unique(np.round(points / SYMMETRY_TOL).astype(np.int64), axis=0)
+
+
+def symmetric_models(models, axes, center):
+    # every material has to map onto itself with the axes reversed about the center
+    groups = {}
+    for name, model in models.items():
+        if not is_port(name):
+            groups.setdefault(get_material(name), []).append(model['data'].reshape(-1, 3))
+    for points in groups.values():
+        points = np.concatenate(points)
+        mirror = points.copy()
+        for axis in axes:
+            mirror[:,axis] = 2 * center[axis] - mirror[:,axis]
+        if not np.array_equal(point_set(points), point_set(mirror)):
+            return False
+    return True
+
+
+def symmetry_boundary(models, axis, center):
+    # ports have to straddle the plane, their direction decides the wall
+    boundary = set()
+    for name, model in models.items():
+        if is_port(name):
+            start, stop = model['start'], model['stop']
+            if abs(start[axis] + stop[axis] - 2 * center) > 2 * SYMMETRY_TOL:
+                return None
+            boundary.add('PEC' if get_portdir(name) == axis else 'PMC')
+    return boundary.pop() if len(boundary) == 1 else None
+
+
+def find_symmetry(models):
+    # planes as (axis, coordinate, boundary), the upper half is simulated
+    if args.symmetry == 'none':
+        return []
+    if args.symmetry != 'auto' and not set(args.symmetry) <= set('xyz'):
+        value_error('Symmetry must be auto, none or a combination of x, y and z')
+    axes = range(3) if args.symmetry == 'auto' else sorted(set('xyz'.index(k) for k in args.symmetry))
+    center = model_center(models)
+    planes = []
+    for axis in axes:
+        boundary = symmetry_boundary(models, axis, center[axis])
+        if args.symmetry != 'auto' and boundary is None:
+            value_error(f'Ports are not symmetric about the {"xyz"[axis]} = {center[axis]:g} plane')
+        if boundary is None or args.symmetry == 'auto' and not symmetric_models(models, [ axis ], center):
+            continue
+        print(f'Symmetry plane {"xyz"[axis]} = {center[axis]:g} mm, {boundary} boundary')
+        planes.append((axis, center[axis], boundary))
+    return planes
+
+
+def port_permutations(models):
+    # port order and polarity under the mirrors and 180 degree rotations of the model,
+    # every transform is a set of axes reversed about the model center
+    ports = sorted([ name for name in models.keys() if is_port(name) ], key=get_portnum)
+    center = model_center(models)
+    result = []
+    for axes in PORT_TRANSFORMS:
+        perm, sign = [], []
+        for name in ports:
+            start, stop = models[name]['start'].copy(), models[name]['stop'].copy()
+            for axis in axes:
+                start[axis], stop[axis] = 2 * center[axis] - stop[axis], 2 * center[axis] - start[axis]
+            match = [ k for k, other in enumerate(ports)
+                      if np.all(np.abs(models[other]['start'] - start) <= 2 * SYMMETRY_TOL)
+                      and np.all(np.abs(models[other]['stop'] - stop) <= 2 * SYMMETRY_TOL)
+                      and get_portdir(other) == get_portdir(name) and get_zo(other) == get_zo(name) ]
+            if not match:
+                break
+            perm.append(match[0])
+            sign.append(-1 if get_portdir(name) in axes else 1)
+        else:
+            if perm != list(range(len(ports))) and symmetric_models(models, axes, center):
+                result.append((perm, sign))
+    return result
+
+
+def plan_excitations(excitations, permutations):
+    # simulate one excitation of every set of symmetric ports, copy the others
+    simulate, derived = [], {}
+    for n in excitations:
+        for perm, sign in permutations:
+            sources = [ m for m in simulate if perm[m] == n ]
+            if sources:
+                derived[n] = (sources[0], perm, sign)
+                break
+        else:
+            simulate.append(n)
+    for n, (m, perm, sign) in derived.items():
+        print(f'Port {n + 1} excitation is a symmetric copy of port {m + 1}')
+    return simulate, derived
+
+
+def permute_column(column, m, perm, sign):
+    # S[perm[i], perm[m]] = sign[i] * sign[m] * S[i, m]
+    result = np.zeros_like(column)
+    result[:,perm] = column * np.array(sign) * sign[m]
+    return result
+
+
+def cut_ports(models, planes):
+    # a PMC wall halves the port width, a PEC wall halves its length
+    for name, model in models.items():
+        if is_port(name):
+            scale = 1
+            for axis, center, boundary in planes:
+                model['start'][axis] = center
+                scale *= 0.5 if boundary == 'PEC' else 2
+            model['scale'] = scale
+
+
+def cut_mesh(lines, planes):
+    tol = args.snap * args.pitch / STL_UNIT
+    for axis, center, boundary in planes:
+        x = lines[axis]
+        lines[axis] = np.vstack([ [[ center, 1 ]], x[x[:,0] > center + tol] ])
+    return lines
+
+
+def mesh_lines(models):
+    # mesh lines per axis as (coordinate, priority, fine) rows,
+    # fine lines are conductor and port edges
+    lines = [ [], [], [] ]
+    for name, model in models.items():
+        start, stop = model['start'], model['stop']
+        priority = get_priority(name)
+        fine = is_port(name) or is_conductor(name)
+        if not is_port(name) and is_air(name):
+            continue
+        for n in range(3):
+            lines[n] += [ (start[n], priority, fine), (stop[n], priority, fine) ]
+    bbox = domain_bounds(models)
+    for n in range(3):
+        lines[n] += [ (bbox[0][n], np.inf, 0), (bbox[1][n], np.inf, 0) ]
+    return [ np.array(x, dtype=np.float64) for x in lines ]
+
+
+def mesh_regions(models):
+    # dielectric extents per axis as (start, stop, epsilon) rows
+    regions = [ [], [], [] ]
+    for name, model in models.items():
+        if is_port(name):
+            continue
+        options = get_custom_material(get_material(name))
+        if 'epsilon' in options:
+            for n in range(3):
+                regions[n].append((model['start'][n], model['stop'][n], options['epsilon']))
+    return regions
+
+
+def snap_lines(lines, tol):
+    # merge lines closer than tol into the highest priority line
+    lines = lines[np.argsort(lines[:,0], kind='stable')]
+    clusters = [ [ lines[0] ] ]
+    for line in lines[1:]:
+        if line[0] - clusters[-1][0][0] <= tol:
+            clusters[-1].append(line)
+        else:
+            clusters.append([ line ])
+    result = []
+    for cluster in clusters:
+        cluster = np.array(cluster)
+        best = cluster[:,1] == np.max(cluster[:,1])
+        result.append((np.mean(cluster[best,0]), np.max(cluster[:,2])))
+    return np.array(result)
+
+
+def snap_mesh(lines):
+    tol = args.snap * args.pitch / STL_UNIT
+    return [ snap_lines(x, tol) for x in lines ]
+
+
+def grade_interval(a, b, left, right, hmax, ratio):
+    # cells grow by ratio away from both ends up to hmax,
+    # only the cells that fit are kept and then stretched to fill the interval
+    h = []
+    pos = a
+    while True:
+        step = min(hmax, left + (pos - a) * (ratio - 1), (right + (b - pos) * (ratio - 1)) / ratio)
+        if pos + step > b * (1 + 1e-12):
+            break
+        h.append(step)
+        pos += step
+    # more cells of hmax in the middle when stretching would exceed it
+    extra = max(1, int(np.ceil((b - a) / hmax * (1 - 1e-9)))) - len(h)
+    if extra > 0:
+        middle = int(np.argmax(h)) if h else 0
+        h[middle:middle] = [ hmax ] * extra
+    h = np.array(h)
+    lo, hi = 0, hmax / h.min()
+    for _ in range(60):
+        scale = (lo + hi) / 2
+        if np.sum(np.minimum(hmax, h * scale)) < b - a:
+            lo = scale
+        else:
+            hi = scale
+    h = np.minimum(hmax, h * hi)
+    x = a + np.concatenate([ [ 0 ], np.cumsum(h) ])
+    x[-1] = b
+    return x
+
+
+def grade_mesh(lines, regions):
+    pitch = args.pitch / STL_UNIT
+    fo, span = frequency_sweep()
+    wavelength = C0 / (fo + span / 2) / STL_UNIT
+    result = []
+    for n in range(3):
+        coord, fine = lines[n][:,0], lines[n][:,1]
+        x = [ coord[:1] ]
+        for i in range(len(coord) - 1):
+            a, b = coord[i], coord[i + 1]
+            eps = [ e for lo, hi, e in regions[n] if lo <= (a + b) / 2 <= hi ]
+            hmax = wavelength / np.sqrt(max(eps, default=1)) / args.cells_per_wavelength
+            hmax = max(hmax, pitch)
+            left = pitch if fine[i] else hmax
+            right = pitch if fine[i + 1] else hmax
+            x.append(grade_interval(a, b, left, right, hmax, args.grading)[1:])
+        result.append(np.concatenate(x))
+    return result
+
+
+def sheet_conductivity(name):
+    material = get_material(name)
+    options = MATERIALS.get(material.split()[0]) or get_custom_material(material)
+    if 'epsilon' in options:
+        return None
+    return options.get('kappa')
+
+
+def sheet_plane(models, name, axis):
+    # the face on another part, so the sheet adds no mesh line of its own
+    tol = args.snap * args.pitch / STL_UNIT
+    start, stop = models[name]['start'][axis], models[name]['stop'][axis]
+    faces = [ x for k, m in models.items() if k != name and not is_air(k)
+              for x in (m['start'][axis], m['stop'][axis]) ]
+    for plane in (start, stop):
+        if any(abs(x - plane) <= tol for x in faces):
+            return plane
+    return (start + stop) / 2
+
+
+def conducting_sheets(models):
+    # thin and flattened boxes of a real metal become sheets,
+    # keeping the conductivity and thickness for the loss
+    count = 0
+    for name, model in models.items():
+        if is_port(name) or model['kind'] not in ('box', 'degenerate') or args.dump_pec:
+            continue
+        kappa = sheet_conductivity(name)
+        size = model['stop'] - model['start']
+        axis = np.argmin(size)
+        if kappa is None or size[axis] >= args.pitch / STL_UNIT:
+            continue
+        thickness = size[axis]
+        if model['kind'] == 'degenerate':
+            if np.count_nonzero(np.isclose(size, 0)) != 1:
+                continue
+            # flattened below STL_TOL, the thickness is still in the vertices
+            thickness = np.ptp(model['data'][...,axis])
+            if thickness <= 0:
+                print(f'WARNING: {name} has no thickness, not added as a conducting sheet')
+                continue
+        model['start'][axis] = model['stop'][axis] = sheet_plane(models, name, axis)
+        model.update(kind='sheet', kappa=kappa, thickness=thickness * STL_UNIT)
+        count += 1
+    return count
+
+
+def build_mesh(models, planes, mesh=None):
+    lines = cut_mesh(snap_mesh(mesh_lines(models)), planes)
+    if (mesh or args.mesh) == 'graded':
+        return grade_mesh(lines, mesh_regions(models))
+    return smooth_mesh(lines)
+
+
+def mesh_cells(lines):
+    return int(np.prod([ max(1, len(x) - 1) for x in lines ]))
+
+
+def compare_mesh(lines, uniform):
+    graded = 'x'.join(str(len(x) - 1) for x in lines)
+    print(f'Graded mesh {graded} = {mesh_cells(lines)} cells, '
+          f'uniform pitch mesh {mesh_cells(uniform)} cells')
+
+
 def add_parts(CSX, models): 
-    pitch = args.pitch
-    mesh = CSX.GetGrid()
-    mesh.SetDeltaUnit(STL_UNIT)
-    bbox = [ None, None ]
     for name in sorted([ k for k in models.keys() if not is_port(k) ]):
         material = get_material(name)
         priority = get_priority(name)
-        start, stop = model_bbox(parse_stl(models[name]))
-
-        # handle <3d surfaces
-        ix = np.logical_or(stop - start < STL_TOL, np.isclose(stop - start, STL_TOL))
-        start[ix] = stop[ix] = ((start + stop) / 2)[ix]
-
-        bbox[0] = start if bbox[0] is None else np.minimum(bbox[0], start)
-        bbox[1] = stop if bbox[1] is None else np.maximum(bbox[1], stop)
+        start, stop = models[name]['start'], models[name]['stop']
 
         # get material
         tag = material.split()[0]
@@ -340,7 +1778,12 @@ def add_parts(CSX, models):
             options = get_custom_material(material)
 
         # set material
-        if options:
+        model = models[name]
+        kind = model['kind']
+        if kind == 'sheet':
+            mat = CSX.AddConductingSheet(name, conductivity=float(model['kappa']),
+                thickness=float(model['thickness']))
+        elif options:
             mat = CSX.AddMaterial(name, **options)
         else:
             mat = CSX.AddMetal(name)
@@ -350,97 +1793,418 @@ def add_parts(CSX, models):
             mat.SetColor(COLORS[tag])
 
         # set model
-        for n in range(3):
-            mesh.AddLine('xyz'[n], [ start[n], stop[n] ])
-        if np.any(np.isclose(stop - start, 0)):
-            prim = mat.AddBox(start, stop, priority=priority)
+        if kind == 'degenerate' or kind == 'box' or kind == 'sheet':
+            mat.AddBox(start, stop, priority=priority)
+        elif kind == 'cylinder':
+            radius = float(model['radius'])
+            mat.AddCylinder(model['p0'], model['p1'], radius, priority=priority)
+        elif kind == 'extrusion':
+            axis = model['axis']
+            mat.AddLinPoly(points=model['points'], norm_dir=axis, elevation=start[axis],
+                length=stop[axis] - start[axis], priority=priority)
         else:
-            prim = mat.AddPolyhedronReader(models[name], priority=priority)
+            prim = mat.AddPolyhedronReader(model['path'], priority=priority)
             prim.ReadFile()
 
-    bbox = np.array(bbox).T
-    mesh.AddLine('x', bbox[0])
-    mesh.AddLine('y', bbox[1])
-    mesh.AddLine('z', bbox[2])
-    return mesh
 
+def port_scales(models):
+    ports = [ name for name in models.keys() if is_port(name) ]
+    return [ models[name].get('scale', 1) for name in sorted(ports, key=get_portnum) ]
 
-def add_ports(FDTD, mesh, models, n):
+
+def port_impedances(models):
+    # as simulated, scaled for ports cut by symmetry planes
+    ports = [ name for name in models.keys() if is_port(name) ]
+    return [ get_zo(name) * scale for name, scale in zip(sorted(ports, key=get_portnum), port_scales(models)) ]
+
+
+def add_ports(FDTD, models, n):
     port = []
     ports = [ name for name in models.keys() if is_port(name) ]
     for name in sorted(ports, key=get_portnum):
         priority = get_priority(name)
-        zo = get_zo(name)
+        zo = get_zo(name) * models[name].get('scale', 1)
         port_nr = get_portnum(name)
         p_dir = get_portdir(name)
         excite = (port_nr == n + 1)
         edges2grid = [ 'yz', 'xz', 'xy' ][p_dir]
-        start, stop = model_bbox(parse_stl(models[name]))
-
-        # handle <3d surfaces
-        ix = np.logical_or(stop - start < STL_TOL, np.isclose(stop - start, STL_TOL))
-        start[ix] = stop[ix] = ((start + stop) / 2)[ix]
-
+        start, stop = models[name]['start'], models[name]['stop']
         p = FDTD.AddLumpedPort(port_nr=port_nr, R=zo, start=start, stop=stop,
             p_dir=p_dir, excite=excite, priority=priority, edges2grid=edges2grid)
         port.append(p)
-        for n in range(3):
-            mesh.AddLine('xyz'[n], [ start[n], stop[n] ])
-
     return port
 
 
-def smooth_mesh(mesh):
+def smooth_mesh(lines):
+    from CSXCAD import ContinuousStructure
     pitch = args.pitch
-    mesh.SmoothMeshLines('all', pitch / STL_UNIT)
+    CSX = ContinuousStructure()
+    mesh = CSX.GetGrid()
+    mesh.SetDeltaUnit(STL_UNIT)
+    for n in range(3):
+        mesh.AddLine('xyz'[n], lines[n][:,0])
+    mesh.SmoothMeshLines('all', pitch / STL_UNIT, ratio=args.grading)
+    return [ mesh.GetLines('xyz'[n]) for n in range(3) ]
+
+
+def mesh_timestep(lines):
+    # courant limit of the smallest cell along every axis
+    pitch = args.pitch
+    cell = np.array([ np.min(np.diff(x), initial=pitch / STL_UNIT) for x in lines ])
+    cell = cell * STL_UNIT
+    dt = 1 / (C0 * np.sqrt(np.sum(1 / cell ** 2)))
+    return cell, dt
+
+
+def check_mesh(lines):
+    pitch = args.pitch
+    cell, dt = mesh_timestep(lines)
+    ratio = pitch / np.min(cell)
+    print(f'Smallest cell {np.min(cell) / STL_UNIT:.4g} mm, estimated timestep {dt:.4g} s')
+    if ratio > args.cell_ratio:
+        message = f'Smallest cell is {ratio:.1f} times less than the pitch'
+        if args.strict_mesh:
+            value_error(message)
+        print(f'WARNING: {message}')
+    return dt
+
+
+def set_mesh(CSX, lines):
+    mesh = CSX.GetGrid()
+    mesh.SetDeltaUnit(STL_UNIT)
+    for n in range(3):
+        mesh.SetLines('xyz'[n], lines[n])
+    return mesh
+
+
+def estimate_timesteps(dt):
+    fo, span = frequency_sweep()
+    criteria = args.criteria or DEFAULT_CRITERIA
+    pulse = 9 / (np.pi * span / 2)  # length of the openems gaussian excitation
+    return int(np.ceil(pulse / dt * (1 + abs(criteria) / DECAY_PER_PULSE)))
+
+
+def load_throughput():
+    filename = cache_dir('machine.json')
+    if os.path.exists(filename):
+        with open(filename) as fp:
+            return json.load(fp)['throughput']
+    return DEFAULT_THROUGHPUT
+
+
+def record_throughput(lines, sim_path, ports, elapsed, speed=None):
+    # the speed openems reports if known, otherwise estimated from the probe length
+    if args.no_cache or not ports or elapsed <= 0:
+        return
+    throughput = speed
+    if not throughput:
+        with open(os.path.join(sim_path, f'port_ut{ports[0].number}'), 'rb') as fp:
+            fp.seek(0, os.SEEK_END)
+            fp.seek(max(0, fp.tell() - 1024))
+            simulated = float(fp.read().split()[-2])
+        cell, dt = mesh_timestep(lines)
+        throughput = mesh_cells(lines) * simulated / dt / elapsed
+    os.makedirs(cache_dir(), exist_ok=True)
+    with open(cache_dir('machine.json'), 'w') as fp:
+        json.dump({ 'throughput': throughput, 'threads': args.threads }, fp)
+
+
+def dry_run(lines, excitations):
+    cells = ' x '.join(str(len(x) - 1) for x in lines)
+    total = mesh_cells(lines)
+    cell, dt = mesh_timestep(lines)
+    timesteps = estimate_timesteps(dt)
+    throughput = load_throughput()
+    runtime = total * timesteps / throughput
+    jobs = min(max(1, args.jobs), len(excitations))
+    print(f'Mesh: {cells} = {total} cells')
+    print(f'Timestep: {dt:.4g} s')
+    print(f'Timesteps: {timesteps} estimated to {args.criteria or DEFAULT_CRITERIA} dB')
+    print(f'Memory: {total * CELL_MEMORY / 1e6:.1f} MB per excitation')
+    print(f'Runtime: {runtime:.0f} s per excitation at {throughput / 1e6:.1f} MC/s, '
+          f'{runtime * np.ceil(len(excitations) / jobs):.0f} s for {len(excitations)} excitations')
+
+
+def simulate_port(models, lines, planes, n, sim_path, frequency):
+    from CSXCAD import ContinuousStructure
+    mark = len(TRACE)
+    with phase('csx', n):
+        CSX = ContinuousStructure()
+        FDTD = setup_simulation(CSX, planes)
+        add_parts(CSX, models)
+        ports = add_ports(FDTD, models, n)
+        set_mesh(CSX, lines)
+
+    if args.farfield:
+        # the far field of the cut side comes from the mirror image
+        mirror = [ 0 ] * 6
+        directions = [ True ] * 6
+        for axis, center, wall in planes:
+            mirror[2 * axis] = 1 if wall == 'PEC' else 2
+            directions[2 * axis] = False
+        kw = {}
+        if args.airbox:
+            kw['start'], kw['stop'] = nf2ff_bounds(models, planes)
+        nf2ff = FDTD.CreateNF2FFBox(mirror=mirror, directions=directions, **kw)
+    if args.show_model:
+        run_appcsxcad(CSX, sim_path)
+    z = port_impedances(models)
+    clear_probes(sim_path, len(z))
+    if args.converge:
+        monitor = start_monitor(sim_path, z, n, frequency)
+    with phase('fdtd', n) as info:
+        elapsed = time.time()
+        if args.profile:
+            os.makedirs(sim_path, exist_ok=True)
+            log = os.path.join(sim_path, 'openems.log')
+            with capture_output(log):
+                run_simulation(FDTD, sim_path)
+            info.update(parse_openems_log(log))
+        else:
+            run_simulation(FDTD, sim_path)
+        elapsed = time.time() - elapsed
+    if args.converge:
+        monitor.terminate()
+    if args.dump_pec:
+        run_paraview(sim_path)
+    if args.jobs <= 1:
+        record_throughput(lines, sim_path, ports, elapsed, info.get('speed'))
+    with phase('calc_port', n):
+        s = np.zeros((len(frequency), len(ports), len(ports)), dtype=np.complex128)
+        signals = read_ports(sim_path, len(ports))
+        if args.converge and os.path.exists(os.path.join(sim_path, 'ABORT')):
+            report_convergence(signals)
+        s[:,:,n] = calc_column(signals, z, n, frequency, args.extrapolate)
+    ff = {}
+    if args.farfield:
+        with phase('nf2ff', n):
+            ff = calc_radiation(sim_path, s, n, nf2ff)
+    packed = pack_signals(signals, n) if args.keep_signals else {}
+    # trace events go back to the parent, also from pool workers
+    events = TRACE[mark:]
+    del TRACE[mark:]
+    return s[:,:,n], ff, packed, events
+
+
+def init_worker(options):
+    global args
+    args = options
+
+
+def worker_options(jobs):
+    threads = args.threads if args.threads > 0 else os.cpu_count()
+    options = argparse.Namespace(**vars(args))
+    options.threads = max(1, threads // jobs)
+    return options
+
+
+def run_excitations(models, lines, planes, excitations, tempdir, frequency, store, signals):
+    # every finished column is written to the store right away
+    jobs = min(max(1, args.jobs), len(excitations))
+    if jobs <= 1:
+        for n in excitations:
+            sim_path = os.path.join(tempdir, 'sim')
+            column, ff, packed, events = simulate_port(models, lines, planes, n, sim_path, frequency)
+            store_column(store, n, column, ff)
+            signals.update(packed)
+            TRACE.extend(events)
+        return
+
+    # each excitation runs in its own process and sim directory
+    options = worker_options(jobs)
+    with ProcessPoolExecutor(jobs, initializer=init_worker, initargs=(options,)) as pool:
+        futures = {}
+        for n in excitations:
+            sim_path = os.path.join(tempdir, f'sim{n + 1}')
+            fut = pool.submit(simulate_port, models, lines, planes, n, sim_path, frequency)
+            futures[fut] = n
+        for fut in as_completed(futures):
+            n = futures[fut]
+            column, ff, packed, events = fut.result()
+            store_column(store, n, column, ff)
+            signals.update(packed)
+            TRACE.extend(events)
+            print(f'port {n + 1} excitation finished')
+
+
+def reprocess():
+    input_filename = signals_filename(os.path.abspath(args.input_filename[0]))
+    output_filename = os.path.abspath(args.output_filename[0])
+
+    with np.load(input_filename) as archive:
+        fo, span, points = archive['sweep']
+        args.frequency = args.frequency or fo
+        args.span = args.span or span
+        args.points = args.points or int(points)
+        # impedances as named, the signals may come from ports cut by symmetry planes
+        nport = len(archive['z'])
+        scale = archive['scale'] if 'scale' in archive else np.ones(nport)
+        z = archive['z'] / scale
+        if args.line:
+            z = np.full(nport, args.line)
+        if args.zo:
+            if len(args.zo) != nport:
+                value_error(f'Exactly {nport} port impedances must be given')
+            z = np.array(args.zo)
+        frequency = get_frequencies()
+        s = np.zeros((len(frequency), nport, nport), dtype=np.complex128)
+        for n in archive['excitations']:
+            signals = unpack_signals(archive, n, nport)
+            s[:,:,n] = calc_column(signals, z * scale, n, frequency, args.extrapolate)
+        for row in archive['derived'] if 'derived' in archive else []:
+            n, m, perm, sign = row[0], row[1], row[2:2 + nport], row[2 + nport:]
+            s[:,:,n] = permute_column(s[:,:,m], m, perm, sign)
+
+    save_results(output_filename, f=frequency, s=s, z=z, ff={})
+    remove_stale(output_filename, 'npz')
 
 
 def main():
     input_filename = os.path.abspath(args.input_filename[0])
     output_filename = os.path.abspath(args.output_filename or input_filename)
+    del TRACE[:]
+    if args.validate:
+        validate_models(unzip_models(input_filename, read=False))
+        return
 
     with tempfile.TemporaryDirectory() as tempdir:
         tempdir = os.path.realpath(tempdir)
-        mod_path = os.path.join(tempdir, 'mod')
-        sim_path = os.path.join(tempdir, 'sim')
-        models = unzip_models(input_filename, mod_path)
-        port_start, port_stop, nport = get_simports(models)
+        with phase('unzip'):
+            members = unzip_models(input_filename)
+            port_start, port_stop, nport = get_simports(members)
+            digests = hash_models(members)
+        key = result_key(digests, port_start, port_stop)
+        if use_cache() and fetch_result(key, output_filename):
+            if args.profile:
+                write_trace(args.profile)
+            return
+        with phase('load_models'):
+            models = load_models(members, digests)
         frequency = get_frequencies()
         z = [ get_zo(name) for name in models.keys() if is_port(name) ]
-        s = np.zeros((len(frequency), nport, nport), dtype=np.complex128)
-        ff = {}
 
         if args.farfield or is_applesilicon():
             if port_stop - port_start > 1:
                 value_error('Only one port can be simulated with farfield or apple silicon')
 
-        for n in range(port_start, port_stop):
-            CSX = ContinuousStructure()
-            FDTD = setup_simulation(CSX)
-            mesh = add_parts(CSX, models)
-            ports = add_ports(FDTD, mesh, models, n)
-            smooth_mesh(mesh)
-
-            if args.farfield:
-                nf2ff = FDTD.CreateNF2FFBox()
-            if args.show_model:
-                run_appcsxcad(CSX, sim_path)
-            run_simulation(FDTD, sim_path)
-            if args.dump_pec:
-                run_paraview()
-            for p in ports:
-                p.CalcPort(sim_path, frequency)
-            calc_sparameters(ports, s, n)
-            if args.farfield:
-                ff = calc_radiation(sim_path, s, n, nf2ff)
-
-    save_results(output_filename, f=frequency, s=s, z=z, ff=ff)
-    if is_applesilicon():
-        os.kill(os.getpid(), 9)
+        with phase('mesh'):
+            if args.airbox:
+                boundary = f'PML_{PML_CELLS}' if args.pml else 'MUR'
+                print(f'Air box: {air_padding():.1f} mm padding, {boundary} boundary')
+            planes = find_symmetry(models)
+            permutations = port_permutations(models) if args.port_symmetry else []
+            cut_ports(models, planes)
+
+            # parse and mesh once, only the excited port changes per run
+            if args.sheets:
+                volume = build_mesh(models, planes)
+                count = conducting_sheets(models)
+            lines = build_mesh(models, planes)
+            if args.sheets and count:
+                print(f'Conducting sheets: {count} parts, {mesh_cells(volume) - mesh_cells(lines)} fewer cells, '
+                      f'timestep {mesh_timestep(volume)[1]:.4g} s to {mesh_timestep(lines)[1]:.4g} s')
+            elif args.sheets and not args.dump_pec:
+                print('WARNING: --sheets found no thin metal parts' +
+                      (', boxes are only recognized with --primitive-tol above 0' if args.primitive_tol <= 0 else ''))
+            if args.mesh == 'graded':
+                compare_mesh(lines, build_mesh(models, planes, 'uniform'))
+            check_mesh(lines)
+        excitations = range(port_start, port_stop)
+        derived = {}
+        if args.port_symmetry:
+            excitations, derived = plan_excitations(excitations, permutations)
+        if args.dry_run:
+            dry_run(lines, excitations)
+            if args.profile:
+                write_trace(args.profile)
+            return
+        with phase('write_polyhedra'):
+            workdir = args.workdir or os.path.join(tempdir, 'mod')
+            write_polyhedra(models, members, digests, workdir)
+        if args.show_model or args.dump_pec:
+            # both exit after showing the first excitation, there is nothing to store
+            simulate_port(models, lines, planes, excitations[0], os.path.join(tempdir, 'sim'), frequency)
+            return
+        store = store_dirname(output_filename)
+        requested = set(excitations) | set(derived)
+        done = open_store(store, frequency, z, nport, result_key(digests, 0, nport), requested)
+        if done:
+            excitations = [ n for n in excitations if n not in done ]
+            derived = { n: v for n, v in derived.items() if n not in done }
+            print(f'Resuming, {len(done)} of {nport} port excitations already finished')
+        signals = {}
+        run_excitations(models, lines, planes, excitations, tempdir, frequency, store, signals)
+        derive_columns(store, derived)
+
+    with phase('save'):
+        finish_store(store, output_filename, nport)
+        if args.keep_signals:
+            save_signals(output_filename, signals, port_impedances(models), port_scales(models),
+                excitations, derived, result_key(digests, 0, nport), done)
+        if use_cache():
+            store_result(key, output_filename)
+    if args.profile:
+        write_trace(args.profile)
+
+
+def options(input_filename, **kw):
+    # the command line defaults, keywords are the long option names with underscores
+    config = parse_args([ os.path.abspath(input_filename) ])
+    for key, value in kw.items():
+        if not hasattr(config, key):
+            raise TypeError(f'Unknown option {key}')
+        setattr(config, key, value)
+    return config
+
+
+@contextlib.contextmanager
+def using(config):
+    # swaps the module args, so runs in one process must not overlap
+    global args
+    saved = args, os.getcwd()
+    args = config
+    try:
+        yield config
+    finally:
+        args = saved[0]
+        os.chdir(saved[1])
+
+
+class Simulation:
+    # in process api, for sweeps that run rfems many times
+    def __init__(self, input_filename, **kw):
+        self.options = options(input_filename, **kw)
+
+    def run(self, **kw):
+        # returns the f, s, z and farfield arrays, keywords override the options for this run
+        config = argparse.Namespace(**vars(self.options))
+        for key, value in kw.items():
+            if not hasattr(config, key):
+                raise TypeError(f'Unknown option {key}')
+            setattr(config, key, value)
+        if config.show_model or config.dump_pec:
+            value_error('show_model and dump_pec exit the process, use them from the command line')
+        with tempfile.TemporaryDirectory() as dirname:
+            if config.output_filename is None:
+                config.output_filename = os.path.join(dirname, 'result.npz')
+            config.output_filename = os.path.abspath(config.output_filename)
+            with using(config):
+                main()
+                return load_results(config.output_filename, mmap=False)
 
 
 if __name__ == '__main__':
-    args = parse_args()
-    main()
+    try:
+        if sys.argv[1:2] == [ 'reprocess' ]:
+            args = parse_reprocess_args(sys.argv[2:])
+            reprocess()
+        else:
+            args = parse_args()
+            main()
+            if is_applesilicon():
+                os.kill(os.getpid(), 9)
+    except RfemsError as e:
+        print(f'ERROR: {e}.')
+        sys.exit(1)
 
 